@@ -0,0 +1,110 @@
+"""rembg による背景の削除（マスク画像の作成）
+
+rembg.remove をセッションなしで呼び出すと、呼び出しのたびにモデルを読み込むため、
+モデルごとのセッションをプロセス内で共有する。ONNX Runtime のセッションは複数スレッドから
+同時に推論できるため、全セッション（Streamlit の利用者）で 1 つを使い回す。
+起動時に warm_up_in_background を呼び出すと、最初の利用者を待たせずにモデルを読み込んでおける。
+"""
+import logging
+import os
+import threading
+import time
+
+from api import lazy
+
+rembg = lazy.module("rembg")
+onnxruntime = lazy.module("onnxruntime")
+
+DEFAULT_MODEL = "u2net"
+# 指定できるモデル（別名 -> rembg のモデル名）
+MODEL_ALIASES = {
+    "u2net": "u2net",
+    "u2netp": "u2netp",
+    "isnet": "isnet-general-use",
+    "isnet-general-use": "isnet-general-use",
+}
+WARMUP_IMAGE_SIZE = (64, 64)
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+_metrics_lock = threading.Lock()
+_metrics = {"session_load_seconds": {}, "mask_count": 0, "mask_seconds_total": 0.0, "mask_seconds_last": None}
+
+def model_name(name=None):
+    """モデル名を解決する。未指定の場合は環境変数 REMBG_MODEL（デフォルト u2net）"""
+    name = name or os.environ.get("REMBG_MODEL", DEFAULT_MODEL)
+    if name not in MODEL_ALIASES:
+        raise ValueError(f"サポートされていないモデルです: {name}（{', '.join(MODEL_ALIASES)} から選択してください）")
+    return MODEL_ALIASES[name]
+
+def _create_session(name):
+    sess_opts = onnxruntime.SessionOptions()
+    # 推論のスレッド数（未指定の場合は ONNX Runtime のデフォルト = 物理コア数）
+    threads = int(os.environ.get("REMBG_THREADS", 0))
+    if threads > 0:
+        sess_opts.intra_op_num_threads = threads
+        sess_opts.inter_op_num_threads = 1
+    for session_class in rembg.sessions.sessions_class:
+        if session_class.name() == name:
+            return session_class(name, sess_opts)
+    return rembg.new_session(name)
+
+def get_session(name=None):
+    """モデルごとに共有する rembg のセッションを取得する（初回のみモデルを読み込む）"""
+    name = model_name(name)
+    session = _sessions.get(name)
+    if session is not None:
+        return session
+    with _sessions_lock:
+        if name not in _sessions:
+            start = time.perf_counter()
+            _sessions[name] = _create_session(name)
+            elapsed = time.perf_counter() - start
+            with _metrics_lock:
+                _metrics["session_load_seconds"][name] = elapsed
+            logging.info(f"rembg のモデル {name} を読み込みました。処理時間：{elapsed:.2f}秒")
+        return _sessions[name]
+
+def remove_background(input_image, alpha_matting=True, model=None):
+    """背景を削除したマスク画像と、推論にかかった時間（モデルの読み込みを除く）を返す"""
+    session = get_session(model)
+    start = time.perf_counter()
+    # only_mask=True でマスク画像のみを出力
+    mask = rembg.remove(input_image, only_mask=True, alpha_matting=alpha_matting, session=session)
+    elapsed = time.perf_counter() - start
+    with _metrics_lock:
+        _metrics["mask_count"] += 1
+        _metrics["mask_seconds_total"] += elapsed
+        _metrics["mask_seconds_last"] = elapsed
+    return mask, elapsed
+
+def get_metrics():
+    """モデルの読み込み時間とマスク作成時間の集計"""
+    with _metrics_lock:
+        metrics = dict(_metrics, session_load_seconds=dict(_metrics["session_load_seconds"]))
+    count = metrics["mask_count"]
+    metrics["mask_seconds_avg"] = metrics["mask_seconds_total"] / count if count else None
+    return metrics
+
+def warm_up(model=None):
+    """モデルを読み込み、小さな画像で 1 回推論して ONNX Runtime を初期化する"""
+    from PIL import Image
+    session = get_session(model)
+    rembg.remove(Image.new("RGB", WARMUP_IMAGE_SIZE), only_mask=True, session=session)
+
+_warm_up_started = False
+
+def warm_up_in_background(model=None):
+    """起動時にバックグラウンドのスレッドでモデルを読み込む。REMBG_WARMUP=off の場合は何もしない"""
+    global _warm_up_started
+    if _warm_up_started or os.environ.get("REMBG_WARMUP", "on").lower() == "off":
+        return
+    _warm_up_started = True
+
+    def run():
+        try:
+            warm_up(model)
+        except Exception as e:
+            logging.warning(f"rembg のウォームアップに失敗しました: {e}")
+
+    threading.Thread(target=run, name="rembg-warmup", daemon=True).start()
@@ -0,0 +1,263 @@
+"""商品画像の背景をまとめて差し替える（インペインティングの一括処理）
+
+ディレクトリ内の画像、またはマニフェスト（CSV）に記載した画像を順に読み込み、
+マスクの作成（rembg、ワーカープロセス）と Bedrock の画像編集を別々のスレッドプールで
+パイプライン処理する。1 枚終わるごとに結果とチェックポイントを書き出すため、
+中断しても同じコマンドで続きから再開できる。
+
+    cd src
+    region=us-west-2 python -m api.batch_inpaint --source-dir store_source/store --output-dir output/store \\
+        --prompt "大理石のテーブルの上、背景は少しボケている"
+
+マニフェストは image_path 列（必須）と prompt / negative_prompt / seed 列（任意、空欄は引数の値）を持つ CSV。
+image_path はマニフェストのディレクトリからの相対パスで指定できる。
+"""
+import argparse
+import csv
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from api import common, env, image_workers, indexer, inpainting
+
+DEFAULT_NEGATIVE_PROMPT = "lowres, error, cropped, worst quality, low quality, jpeg artifacts, ugly, out of frame"
+DEFAULT_MAX_DIMENSION = 1024
+DEFAULT_MASK_WORKERS = 2  # マスクを作成するスレッド数（処理自体は image_workers のプロセスで実行する）
+DEFAULT_EDIT_WORKERS = 4  # Bedrock への同時リクエスト数（モデルごとのレート制限は api.common で共有）
+CHECKPOINT_FILE = "checkpoint.jsonl"
+REPORT_INTERVAL = 10  # 何枚ごとにスループットを表示するか
+
+def iter_jobs(source_dir=None, manifest=None, prompt=None, negative_prompt=DEFAULT_NEGATIVE_PROMPT, seed=0):
+    """処理対象の画像を 1 件ずつ返す（全件をメモリに読み込まない）"""
+    defaults = {"prompt": prompt, "negative_prompt": negative_prompt, "seed": seed}
+    if manifest:
+        base_dir = os.path.dirname(manifest)
+        with open(manifest, 'r', encoding="utf-8", newline="") as f:
+            for row in csv.DictReader(f, skipinitialspace=True):
+                image_path = row["image_path"]
+                if not os.path.isabs(image_path):
+                    image_path = os.path.join(base_dir, image_path)
+                job = {"image_path": image_path}
+                for key, value in defaults.items():
+                    job[key] = row.get(key) or value
+                job["seed"] = int(job["seed"])
+                yield job
+    else:
+        for image_path in indexer.list_image_files(source_dir):
+            yield dict(defaults, image_path=image_path)
+
+class Checkpoint:
+    """処理済みの画像を JSON Lines で記録する。再開時は status が done の画像を飛ばす"""
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        if os.path.exists(path):
+            with open(path, 'r', encoding="utf-8") as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    record = json.loads(line)
+                    if record.get("status") == "done":
+                        self.done.add(record["image_path"])
+        self._lock = threading.Lock()
+        self._file = open(path, 'a', encoding="utf-8")
+
+    def record(self, **record):
+        with self._lock:
+            self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self._file.flush()
+            if record.get("status") == "done":
+                self.done.add(record["image_path"])
+
+    def close(self):
+        self._file.close()
+
+class Throughput:
+    """処理枚数と images/min を集計する"""
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.done = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+
+    def add(self, ok):
+        with self._lock:
+            if ok:
+                self.done += 1
+            else:
+                self.failed += 1
+            return self.done + self.failed
+
+    def images_per_minute(self):
+        elapsed = time.perf_counter() - self.start
+        return self.done / elapsed * 60 if elapsed > 0 else 0.0
+
+    def summary(self):
+        return (
+            f"成功 {self.done} 件 / 失敗 {self.failed} 件 / "
+            f"{self.images_per_minute():.1f} images/min / 経過時間 {time.perf_counter() - self.start:.1f}秒"
+        )
+
+class BatchInpainter:
+    """マスクの作成と画像編集をパイプライン処理する"""
+    def __init__(
+        self,
+        output_dir,
+        model_id=inpainting.TITAN_IMAGE_MODEL_ID,
+        num_images=1,
+        max_dimension=DEFAULT_MAX_DIMENSION,
+        invert_mask=False,
+        mask_workers=DEFAULT_MASK_WORKERS,
+        edit_workers=DEFAULT_EDIT_WORKERS,
+        save_masks=False,
+    ):
+        self.output_dir = output_dir
+        self.model_id = model_id
+        self.num_images = num_images
+        self.max_dimension = max_dimension
+        self.invert_mask = invert_mask
+        self.mask_workers = mask_workers
+        self.edit_workers = edit_workers
+        self.save_masks = save_masks
+        self.client = common.get_client("bedrock-runtime")
+        self.translator = inpainting.Translator()
+        self._translations = {}
+        self._translations_lock = threading.Lock()
+
+    def translate(self, prompt):
+        """同じプロンプトの英訳は 1 回だけ行う"""
+        with self._translations_lock:
+            if prompt in self._translations:
+                return self._translations[prompt]
+        translated = self.translator.translate_text(prompt)
+        with self._translations_lock:
+            self._translations[prompt] = translated
+        return translated
+
+    def output_paths(self, image_path):
+        stem = os.path.splitext(os.path.basename(image_path))[0]
+        return [os.path.join(self.output_dir, f"{stem}_{i}.png") for i in range(self.num_images)]
+
+    def mask_stage(self, job):
+        """画像を読み込んで縮小し、マスクを作成する"""
+        start = time.perf_counter()
+        with Image.open(job["image_path"]) as image:
+            image = image_workers.resize_to_fit(image.convert("RGB"), self.max_dimension)
+        mask, _, _ = inpainting.create_mask(image, invert=self.invert_mask)
+        return image, mask, time.perf_counter() - start
+
+    def edit_stage(self, job, image, mask):
+        """Bedrock で画像を編集し、結果を保存する"""
+        start = time.perf_counter()
+        body = inpainting.build_edit_image_body(
+            self.model_id, "INPAINTING", self.translate(job["prompt"]), job["negative_prompt"],
+            image, mask, self.num_images, job["seed"],
+        )
+        images = inpainting.invoke_edit_image(self.client, self.model_id, body)
+        paths = self.output_paths(job["image_path"])[:len(images)]
+        for generated, path in zip(images, paths):
+            generated.save(path)
+        if self.save_masks:
+            stem = os.path.splitext(os.path.basename(job["image_path"]))[0]
+            mask.save(os.path.join(self.output_dir, f"{stem}_mask.png"))
+        return paths, time.perf_counter() - start
+
+    def run(self, jobs, checkpoint):
+        """jobs を処理し、Throughput を返す
+
+        同時に処理中の画像はマスク・画像編集のスレッド数の合計までに抑え、
+        読み込んだ画像がメモリに溜まり続けないようにする。
+        """
+        os.makedirs(self.output_dir, exist_ok=True)
+        throughput = Throughput()
+        in_flight = threading.BoundedSemaphore(self.mask_workers + self.edit_workers)
+        mask_pool = ThreadPoolExecutor(max_workers=self.mask_workers, thread_name_prefix="mask")
+        edit_pool = ThreadPoolExecutor(max_workers=self.edit_workers, thread_name_prefix="edit")
+
+        def finish(job, ok, **record):
+            count = throughput.add(ok)
+            checkpoint.record(image_path=job["image_path"], status="done" if ok else "error", **record)
+            in_flight.release()
+            if count % REPORT_INTERVAL == 0:
+                logging.info(throughput.summary())
+
+        def edit(job, mask_future):
+            try:
+                image, mask, mask_seconds = mask_future.result()
+                paths, edit_seconds = self.edit_stage(job, image, mask)
+            except Exception as e:
+                logging.error(f"{job['image_path']}: {e}")
+                finish(job, False, error=str(e))
+                return
+            finish(job, True, outputs=paths, mask_seconds=round(mask_seconds, 3), edit_seconds=round(edit_seconds, 3))
+
+        try:
+            for job in jobs:
+                if job["image_path"] in checkpoint.done:
+                    continue
+                in_flight.acquire()
+                mask_future = mask_pool.submit(self.mask_stage, job)
+                # マスクができた画像から順に画像編集に回す（次の画像のマスク作成と並行して進む）
+                mask_future.add_done_callback(lambda future, job=job: edit_pool.submit(edit, job, future))
+        finally:
+            mask_pool.shutdown(wait=True)
+            edit_pool.shutdown(wait=True)
+        return throughput
+
+def main():
+    parser = argparse.ArgumentParser(description="商品画像の背景をまとめてインペインティングで差し替えます。")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--source-dir", help="処理する画像のディレクトリ")
+    source.add_argument("--manifest", help="処理する画像を記載した CSV (image_path[, prompt, negative_prompt, seed])")
+    parser.add_argument("--output-dir", required=True, help="生成した画像の保存先")
+    parser.add_argument("--prompt", help="生成する背景のプロンプト（日本語可、Amazon Translate で英訳する）")
+    parser.add_argument("--negative-prompt", default=DEFAULT_NEGATIVE_PROMPT, help="ネガティブプロンプト")
+    parser.add_argument("--seed", type=int, default=0, help="シード値")
+    parser.add_argument("--num-images", type=int, default=1, help="1 枚の画像から生成する枚数")
+    parser.add_argument("--model-id", default=inpainting.TITAN_IMAGE_MODEL_ID, choices=(inpainting.TITAN_IMAGE_MODEL_ID, inpainting.SDXL_MODEL_ID))
+    parser.add_argument("--max-dimension", type=int, default=DEFAULT_MAX_DIMENSION, help="処理前に縮小する長辺のピクセル数")
+    parser.add_argument("--invert-mask", action="store_true", help="物体の部分を黒にしたマスクを使う（design-generation と同じ）")
+    parser.add_argument("--mask-workers", type=int, default=DEFAULT_MASK_WORKERS, help="マスク作成の同時実行数")
+    parser.add_argument("--edit-workers", type=int, default=DEFAULT_EDIT_WORKERS, help="Bedrock への同時リクエスト数")
+    parser.add_argument("--save-masks", action="store_true", help="マスク画像も保存する")
+    parser.add_argument("--checkpoint", help=f"チェックポイントのパス (デフォルト: <output-dir>/{CHECKPOINT_FILE})")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    env.load_env_if_exists()
+    if args.source_dir and not args.prompt:
+        parser.error("--source-dir を指定する場合は --prompt が必要です")
+    if args.model_id == inpainting.SDXL_MODEL_ID and args.num_images != 1:
+        parser.error("Stable Diffusion XL の場合、--num-images は 1 のみ指定できます")
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    checkpoint = Checkpoint(args.checkpoint or os.path.join(args.output_dir, CHECKPOINT_FILE))
+    if checkpoint.done:
+        logging.info(f"チェックポイントから再開します（処理済み {len(checkpoint.done)} 件）")
+    inpainter = BatchInpainter(
+        args.output_dir,
+        model_id=args.model_id,
+        num_images=args.num_images,
+        max_dimension=args.max_dimension,
+        invert_mask=args.invert_mask,
+        mask_workers=args.mask_workers,
+        edit_workers=args.edit_workers,
+        save_masks=args.save_masks,
+    )
+    image_workers.warm_up_in_background()
+    try:
+        throughput = inpainter.run(
+            iter_jobs(args.source_dir, args.manifest, args.prompt, args.negative_prompt, args.seed),
+            checkpoint,
+        )
+    finally:
+        checkpoint.close()
+    logging.info(f"完了しました。{throughput.summary()}")
+
+if __name__ == "__main__":
+    main()
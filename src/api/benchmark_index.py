@@ -0,0 +1,87 @@
+"""近似最近傍探索インデックスの再現率と検索時間を Flat（全件走査）と比較する
+
+index/ に保存済みのインデックスからベクトルを復元して利用する。デモのストアは件数が少ないため、
+--size を指定すると保存済みのベクトルにノイズを加えて件数を水増しした上で比較する。
+
+    cd src
+    python -m api.benchmark_index --store store --size 100000 --k 10
+"""
+import argparse
+import time
+
+import faiss
+import numpy as np
+
+from api import vector_store
+
+def load_vectors(store_name, index_dir="index"):
+    """保存済みのテキスト・画像インデックスから全ベクトルを復元する"""
+    paths = vector_store.index_paths(store_name, index_dir)
+    vectors = []
+    for key in ("txt_index", "img_index"):
+        index = faiss.read_index(paths[key])
+        vectors.append(index.reconstruct_n(0, index.ntotal))
+    return np.vstack(vectors)
+
+def augment(vectors, size, noise=0.05, seed=0):
+    """保存済みのベクトルにノイズを加えて size 件に増やす"""
+    rng = np.random.default_rng(seed)
+    base = vectors[rng.integers(0, len(vectors), size)]
+    scale = noise * np.linalg.norm(vectors, axis=1).mean() / np.sqrt(vectors.shape[1])
+    return (base + rng.normal(0, scale, base.shape)).astype(np.float32)
+
+def timed_search(index, queries, k):
+    start = time.perf_counter()
+    _, ids = index.search(queries, k)
+    return ids, (time.perf_counter() - start) / len(queries) * 1000
+
+def recall_at_k(ids, ground_truth):
+    hits = sum(len(set(row) & set(gt)) for row, gt in zip(ids, ground_truth))
+    return hits / ground_truth.size
+
+def run(database, queries, k, index_types, sweeps):
+    """インデックスの種類ごとに 1 回構築し、検索パラメータを変えながら再現率と検索時間を求める"""
+    flat = vector_store.create_index(database.shape[1], vector_store.resolve_index_params({"index_type": "flat"}, len(database)))
+    flat.add(database)
+    ground_truth, flat_ms = timed_search(flat, queries, k)
+    results = [("flat", "-", 0.0, 1.0, flat_ms)]
+    for index_type in index_types:
+        params = vector_store.resolve_index_params({"index_type": index_type}, len(database))
+        if params["index_type"] != index_type:
+            print(f"{index_type}: 件数が少なく学習できないためスキップします")
+            continue
+        start = time.perf_counter()
+        index = vector_store.create_index(database.shape[1], params)
+        vector_store.train_index(index, database)
+        index.add(database)
+        build_sec = time.perf_counter() - start
+        param_name = "efSearch" if index_type == "hnsw" else "nprobe"
+        for value in sweeps[param_name]:
+            vector_store.apply_search_params(index, dict(params, **{param_name: value}))
+            ids, ms = timed_search(index, queries, k)
+            results.append((index_type, f"{param_name}={value}", build_sec, recall_at_k(ids, ground_truth), ms))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="近似最近傍探索インデックスの再現率と検索時間を Flat と比較します。")
+    parser.add_argument("--store", default="store", help="ベクトルを取得するストア名")
+    parser.add_argument("--index-dir", default="index", help="インデックスの保存先")
+    parser.add_argument("--size", type=int, default=0, help="ノイズを加えて水増しする件数（0 の場合は保存済みのベクトルのみ）")
+    parser.add_argument("--queries", type=int, default=200, help="クエリ数")
+    parser.add_argument("--k", type=int, default=10, help="検索件数")
+    args = parser.parse_args()
+
+    vectors = load_vectors(args.store, args.index_dir)
+    database = augment(vectors, args.size) if args.size else vectors
+    queries = augment(vectors, args.queries, seed=1)
+    k = min(args.k, len(database))
+
+    sweeps = {"efSearch": (16, 64, 256), "nprobe": (1, 8, 32)}
+
+    print(f"件数: {len(database)}  次元数: {database.shape[1]}  クエリ数: {len(queries)}  k: {k}")
+    print(f"{'index':<10}{'param':<14}{'build(s)':>10}{'recall@k':>10}{'ms/query':>10}")
+    for index_type, param, build_sec, recall, ms in run(database, queries, k, vector_store.INDEX_TYPES[1:], sweeps):
+        print(f"{index_type:<10}{param:<14}{build_sec:>10.2f}{recall:>10.3f}{ms:>10.3f}")
+
+if __name__ == "__main__":
+    main()
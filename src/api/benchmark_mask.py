@@ -0,0 +1,61 @@
+"""マスクの 2 値化の処理時間を、従来の PIL の point（画素ごとの lambda）と比較する
+
+rembg の出力に近いグレースケールのマスク（ぼけた楕円 + ノイズ）を作成して計測する。
+
+    cd src
+    python -m api.benchmark_mask --sizes 1024 3840 --repeat 10
+"""
+import argparse
+import time
+
+import numpy as np
+from PIL import Image
+
+from api import masking
+
+def make_mask(size, seed=0):
+    """size x size の、rembg の出力に近いグレースケールのマスクを作成する"""
+    rng = np.random.default_rng(seed)
+    y, x = np.ogrid[:size, :size]
+    distance = ((x - size / 2) / (size * 0.35)) ** 2 + ((y - size / 2) / (size * 0.3)) ** 2
+    mask = np.clip((1.2 - distance) * 255, 0, 255) + rng.normal(0, 8, (size, size))
+    return Image.fromarray(np.clip(mask, 0, 255).astype(np.uint8))
+
+def timed(func, repeat):
+    """repeat 回実行した中央値（ミリ秒）"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append((time.perf_counter() - start) * 1000)
+    return float(np.median(times))
+
+def run(size, repeat):
+    mask = make_mask(size)
+    threshold = masking.THRESHOLD
+    cases = [
+        ("PIL point (lambda)", lambda: mask.point(lambda x: 0 if x > threshold else 255)),
+        ("LUT", lambda: masking.process_mask(mask, invert=True)),
+        ("LUT（配列）", lambda: masking.binarize(mask, invert=True)),
+        ("LUT + 穴埋め + 膨張", lambda: masking.process_mask(mask, invert=True, fill=True, dilate_radius=4)),
+        ("LUT + 全処理", lambda: masking.process_mask(mask, invert=True, fill=True, dilate_radius=4, erode_radius=2, feather_radius=3)),
+    ]
+    # 従来の処理と結果が一致することを確認する
+    expected = np.asarray(cases[0][1]())
+    if not (np.array_equal(np.asarray(cases[1][1]()), expected) and np.array_equal(cases[2][1](), expected)):
+        raise RuntimeError("従来の処理と 2 値化の結果が一致しません")
+    return [(name, timed(func, repeat)) for name, func in cases]
+
+def main():
+    parser = argparse.ArgumentParser(description="マスクの 2 値化の処理時間を従来の処理と比較します。")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1024, 3840], help="マスクの一辺のピクセル数")
+    parser.add_argument("--repeat", type=int, default=10, help="計測の繰り返し回数")
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        print(f"{size} x {size}")
+        for name, ms in run(size, args.repeat):
+            print(f"    {name:<28}{ms:>10.2f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""商品リスト（image_name, item_name, item_desc）を image_name で引けるカタログとして共有する
+
+商品リストの CSV は一度だけ読み込み、列ごとの NumPy 配列と image_name から行番号への辞書で保持する。
+商品名・商品説明文は辞書を引くだけで取得でき、読み込んだカタログはディレクトリと CSV の更新時刻を
+キーに全セッションで共有する。
+"""
+import csv
+import os
+import threading
+
+import numpy as np
+
+ITEM_LIST_EXTENSIONS = (".csv", ".txt")
+COLUMNS = ("image_name", "item_name", "item_desc")
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+def list_item_list_files(dir_path):
+    """ディレクトリ内の商品リストのパスをファイル名順に取得する"""
+    files = sorted(f for f in os.listdir(dir_path) if f.endswith(ITEM_LIST_EXTENSIONS))
+    return [os.path.join(dir_path, f) for f in files]
+
+def read_item_list_csv(file):
+    """商品リストの CSV（1 行目はヘッダー）を行のリストとして読み込む。file はパスまたはファイルオブジェクト"""
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, 'r', encoding="utf-8", newline="") as f:
+            return read_item_list_csv(f)
+    reader = csv.reader(file, skipinitialspace=True, quotechar='"')
+    next(reader, None)
+    return [tuple(row[:len(COLUMNS)]) for row in reader if len(row) >= len(COLUMNS)]
+
+class Catalog:
+    """image_name をキーに商品名・商品説明文を定数時間で取得する読み取り専用のカタログ"""
+    def __init__(self, rows=()):
+        rows = list(rows)
+        columns = list(zip(*rows)) if rows else [()] * len(COLUMNS)
+        self.columns = {name: np.array(values, dtype=object) for name, values in zip(COLUMNS, columns)}
+        # 同じ image_name が複数ある場合は先頭の行を使う
+        self._rows = {}
+        for i, image_name in enumerate(self.columns["image_name"]):
+            self._rows.setdefault(image_name, i)
+
+    @classmethod
+    def from_files(cls, paths):
+        rows = []
+        for path in paths:
+            rows.extend(read_item_list_csv(path))
+        return cls(rows)
+
+    def __len__(self):
+        return len(self.columns["image_name"])
+
+    def __contains__(self, image_name):
+        return image_name in self._rows
+
+    @property
+    def image_names(self):
+        return self.columns["image_name"]
+
+    @property
+    def item_descs(self):
+        return self.columns["item_desc"]
+
+    def get(self, image_name, column):
+        return self.columns[column][self._rows[image_name]]
+
+    def item_name(self, image_name):
+        return self.get(image_name, "item_name")
+
+    def item_desc(self, image_name):
+        return self.get(image_name, "item_desc")
+
+    def to_records(self):
+        """画面表示用に行の辞書のリストを返す"""
+        return [dict(zip(COLUMNS, row)) for row in zip(*(self.columns[name] for name in COLUMNS))]
+
+def load_catalog(dir_path):
+    """ディレクトリ内の商品リストをまとめたカタログを取得する。戻り値は共有オブジェクトのため変更しないこと"""
+    paths = list_item_list_files(dir_path)
+    key = tuple((path, os.path.getmtime(path)) for path in paths)
+    with _cache_lock:
+        entry = _cache.get(dir_path)
+        if entry is not None and entry[0] == key:
+            return entry[1]
+    catalog = Catalog.from_files(paths)
+    with _cache_lock:
+        _cache[dir_path] = (key, catalog)
+    return catalog
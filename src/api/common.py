@@ -2,8 +2,336 @@ import json
 import boto3
 import os
 import base64
+import hashlib
 import io
+import itertools
+import random
+import threading
+import time
+from botocore.config import Config
+from botocore.exceptions import ClientError
 from PIL import Image
+from api import embedding_cache, image_store
+
+# Titan Multimodal Embeddings の出力次元数
+TITAN_EMBEDDING_MODEL_ID = "amazon.titan-embed-image-v1"
+TITAN_EMBEDDING_DIMENSION = 1024
+
+# Claude に入力する画像のサイズと形式
+# 長辺 1568px・約 1.15 メガピクセルを超える画像はモデル側で縮小されるため、送信前に縮小しておく
+LLM_IMAGE_MAX_EDGE = 1568
+LLM_IMAGE_MAX_PIXELS = 1_150_000
+LLM_IMAGE_QUALITY = 85
+DEFAULT_LLM_IMAGE_CACHE_ITEMS = 256
+
+# そのまま Bedrock に送信できる画像形式（PNG / JPEG）のファイル先頭のバイト列
+IMAGE_SIGNATURES = (b"\x89PNG\r\n\x1a\n", b"\xff\xd8\xff")
+
+# boto3 クライアントの HTTP コネクションプール設定のデフォルト値
+DEFAULT_MAX_POOL_CONNECTIONS = 50
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_client(service_name="bedrock-runtime", region_name=None):
+    """(リージョン, サービス) ごとにプロセス内で共有する boto3 クライアントを取得する
+
+    boto3 のクライアントはスレッドセーフなため、Streamlit の全セッションで使い回し、
+    クライアント生成・認証情報の解決・TLS 接続のコストを初回のみに抑える。
+    """
+    region_name = region_name or os.environ['region']
+    key = (region_name, service_name)
+    client = _clients.get(key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                # .env の読み込み後に参照できるよう、設定は生成時に環境変数から取得する
+                config = Config(
+                    max_pool_connections=int(os.environ.get("BOTO3_MAX_POOL_CONNECTIONS", DEFAULT_MAX_POOL_CONNECTIONS)),
+                    tcp_keepalive=os.environ.get("BOTO3_TCP_KEEPALIVE", "true").lower() == "true",
+                )
+                # Session はスレッドセーフではないため、ロック内で都度生成する
+                session = boto3.session.Session()
+                client = session.client(service_name=service_name, region_name=region_name, config=config)
+                _clients[key] = client
+    return client
+
+class TokenBucket:
+    """スレッドセーフなトークンバケット
+
+    rate は 1 秒あたりに補充するトークン数、capacity はバースト可能な最大トークン数。
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self, tokens):
+        """トークンを取得できれば 0、できなければ不足分が補充されるまでの秒数を返す"""
+        tokens = min(tokens, self.capacity)
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0.0
+            return (tokens - self._tokens) / self.rate
+
+    def acquire(self, tokens=1):
+        """トークンを取得できるまで待機し、待機した秒数を返す"""
+        waited = 0.0
+        while (wait := self._reserve(tokens)) > 0:
+            time.sleep(wait)
+            waited += wait
+        return waited
+
+    def release(self, tokens):
+        """取得したトークンを返却する（見積もりより実際の消費が少なかった場合）"""
+        with self._lock:
+            self._tokens = min(self.capacity, self._tokens + tokens)
+
+# モデルごとのリクエスト数 (rpm) とトークン数 (tpm) の上限。
+# Bedrock のオンデマンドのクォータを目安にした値のため、アカウントの Service Quotas に合わせて
+# 環境変数 BEDROCK_RATE_LIMITS (例: {"anthropic.claude-3-haiku-20240307-v1:0": {"rpm": 1000, "tpm": 2000000}}) で上書きする。
+DEFAULT_RATE_LIMITS = {
+    "anthropic.claude-3-haiku-20240307-v1:0": {"rpm": 1000, "tpm": 2000000},
+    "anthropic.claude-3-sonnet-20240229-v1:0": {"rpm": 500, "tpm": 1000000},
+    "anthropic.claude-3-5-sonnet-20240620-v1:0": {"rpm": 50, "tpm": 400000},
+    "amazon.titan-embed-image-v1": {"rpm": 2000, "tpm": None},
+    "amazon.titan-image-generator-v1": {"rpm": 60, "tpm": None},
+    "stability.stable-diffusion-xl-v1": {"rpm": 60, "tpm": None},
+}
+DEFAULT_RPM = 100  # 上記に含まれないモデルのリクエスト数の上限
+MAX_RETRIES = 6  # スロットリング時の最大リトライ回数
+IMAGE_TOKEN_ESTIMATE = 1600  # Claude の画像 1 枚あたりのトークン数の目安
+
+class ModelRateLimiter:
+    """1 モデル分のリクエスト数・トークン数のトークンバケットと待機時間のメトリクス"""
+    def __init__(self, rpm, tpm=None):
+        self.requests = TokenBucket(rpm / 60, capacity=rpm)
+        self.tokens = TokenBucket(tpm / 60, capacity=tpm) if tpm else None
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.throttled = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _record(self, waited):
+        with self._lock:
+            self.calls += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+
+    def record_throttled(self):
+        with self._lock:
+            self.throttled += 1
+
+    def acquire(self, tokens=0):
+        waited = self.requests.acquire()
+        if self.tokens and tokens:
+            waited += self.tokens.acquire(tokens)
+        self._record(waited)
+        return waited
+
+    def refund(self, estimated, used):
+        """見積もり（estimate_tokens）で取得したトークンのうち、実際に使わなかった分を返却する"""
+        if not self.tokens:
+            return
+        unused = min(estimated, self.tokens.capacity) - used
+        if unused > 0:
+            self.tokens.release(unused)
+
+    def metrics(self):
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "throttled": self.throttled,
+                "total_wait": self.total_wait,
+                "avg_wait": self.total_wait / self.calls if self.calls else 0.0,
+                "max_wait": self.max_wait,
+            }
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+def get_rate_limiter(model_id):
+    """モデルごとにプロセス内（全セッション）で共有するレートリミッターを取得する"""
+    with _rate_limiters_lock:
+        if model_id not in _rate_limiters:
+            limits = dict(DEFAULT_RATE_LIMITS)
+            limits.update(json.loads(os.environ.get("BEDROCK_RATE_LIMITS", "{}")))
+            limit = limits.get(model_id, {})
+            _rate_limiters[model_id] = ModelRateLimiter(
+                limit.get("rpm") or int(os.environ.get("BEDROCK_DEFAULT_RPM", DEFAULT_RPM)),
+                limit.get("tpm"),
+            )
+        return _rate_limiters[model_id]
+
+def get_rate_limit_metrics():
+    """モデルごとの待機時間・スロットリング回数のメトリクスを取得する"""
+    with _rate_limiters_lock:
+        limiters = dict(_rate_limiters)
+    return {model_id: limiter.metrics() for model_id, limiter in limiters.items()}
+
+def estimate_tokens(body):
+    """リクエストボディからトークン数（入力 + 最大出力）を概算する"""
+    if isinstance(body, (str, bytes)):
+        body = json.loads(body)
+    tokens = body.get("max_tokens", 0) + len(body.get("system", "")) + len(body.get("inputText", ""))
+    for message in body.get("messages", []):
+        content = message.get("content", "")
+        if isinstance(content, str):
+            tokens += len(content)
+            continue
+        for block in content:
+            if block.get("type") == "image":
+                tokens += IMAGE_TOKEN_ESTIMATE
+            else:
+                tokens += len(block.get("text", ""))
+    return tokens
+
+def used_tokens(usage):
+    """レスポンスの usage から実際に消費したトークン数（入力 + 出力）を求める"""
+    return (
+        usage.get("input_tokens", 0)
+        + usage.get("cache_read_input_tokens", 0)
+        + usage.get("cache_creation_input_tokens", 0)
+        + usage.get("output_tokens", 0)
+    )
+
+def refund_tokens(model_id, body, usage):
+    """リクエスト前に max_tokens を含めて見積もったトークン数と、実際の usage との差分を返却する
+
+    出力トークンは max_tokens（LP 作成では 100000）で見積もるため、返却しないと
+    実際のクォータに余裕があってもトークン数の上限で待機してしまう。
+    """
+    if usage and ("input_tokens" in usage or "output_tokens" in usage):
+        get_rate_limiter(model_id).refund(estimate_tokens(body), used_tokens(usage))
+
+def is_throttling_error(e):
+    """Bedrock のスロットリングエラーかどうかを判定する"""
+    return isinstance(e, ClientError) and e.response.get("Error", {}).get("Code") in (
+        "ThrottlingException",
+        "TooManyRequestsException",
+        "ServiceUnavailableException",
+    )
+
+def backoff_seconds(attempt, base=0.5, cap=20.0):
+    """ジッター付き指数バックオフの待機秒数"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+def call_with_rate_limit(model_id, body, func, max_retries=MAX_RETRIES):
+    """レート制限に従って func を呼び出し、スロットリング時はリトライする
+
+    失敗したリクエストはクォータを消費しないため、見積もったトークンを返却してから待機・再送する。
+    """
+    limiter = get_rate_limiter(model_id)
+    tokens = estimate_tokens(body)
+    for attempt in range(max_retries + 1):
+        limiter.acquire(tokens)
+        try:
+            return func()
+        except Exception as e:
+            limiter.refund(tokens, 0)
+            if not is_throttling_error(e) or attempt == max_retries:
+                raise
+            limiter.record_throttled()
+            time.sleep(backoff_seconds(attempt))
+
+def invoke_model(client, body, modelId, max_retries=MAX_RETRIES, **kwargs):
+    """レート制限とスロットリング時のリトライ付きで Bedrock の invoke_model を呼び出す
+
+    呼び出し元で独自にリトライする場合は max_retries=0 を指定する（リトライを二重にしない）。
+    """
+    if not isinstance(body, (str, bytes)):
+        body = json.dumps(body)
+    response = call_with_rate_limit(
+        modelId,
+        body,
+        lambda: client.invoke_model(
+            body=body,
+            modelId=modelId,
+            accept="application/json",
+            contentType="application/json",
+            **kwargs,
+        ),
+        max_retries=max_retries,
+    )
+    if get_rate_limiter(modelId).tokens:
+        # usage を読むため、レスポンスのボディを読み込んで呼び出し元が read できる形に戻す
+        response_bytes = response["body"].read()
+        response["body"] = io.BytesIO(response_bytes)
+        try:
+            refund_tokens(modelId, body, json.loads(response_bytes).get("usage"))
+        except ValueError:
+            pass
+    return response
+
+def invoke_model_stream(client, body, modelId, usage=None):
+    """Claude をストリーミングで呼び出し、生成されたテキストの差分を順に返すジェネレーター
+
+    usage に dict を渡すと、入力・出力のトークン数（usage の値。プロンプトキャッシュの
+    cache_read_input_tokens / cache_creation_input_tokens を含む）を書き込む。
+    受信を終えた時点（途中で失敗・中断した場合を含む）で、見積もりと受信済みの usage との差分の
+    トークンをレートリミッターに返却する。
+    """
+    if usage is None:
+        usage = {}
+    if not isinstance(body, (str, bytes)):
+        body = json.dumps(body)
+    response = call_with_rate_limit(
+        modelId,
+        body,
+        lambda: client.invoke_model_with_response_stream(
+            body=body,
+            modelId=modelId,
+            accept="application/json",
+            contentType="application/json",
+        ),
+    )
+    try:
+        for event in response.get("body"):
+            chunk = event.get("chunk")
+            if not chunk:
+                continue
+            chunk_body = json.loads(chunk.get("bytes"))
+            if chunk_body.get("type") == "message_start":
+                usage.update(chunk_body.get("message", {}).get("usage", {}))
+            elif chunk_body.get("type") == "message_delta":
+                usage.update(chunk_body.get("usage", {}))
+            if chunk_body.get("type") == "content_block_delta":
+                text = chunk_body.get("delta", {}).get("text")
+                if text:
+                    yield text
+    finally:
+        get_rate_limiter(modelId).refund(estimate_tokens(body), used_tokens(usage))
+
+class StreamTimer:
+    """ストリーミング応答の初回トークンまでの時間と全体の処理時間を計測する
+
+    st.write_stream(timer.wrap(stream)) のように、ストリームを包んで利用する。
+    """
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.time_to_first_token = None
+        self.duration = None
+
+    def wrap(self, stream):
+        for chunk in stream:
+            if self.time_to_first_token is None:
+                self.time_to_first_token = time.perf_counter() - self.start
+            yield chunk
+        self.duration = time.perf_counter() - self.start
+
+    def summary(self):
+        """画面表示用の計測結果"""
+        ttft = self.time_to_first_token or 0.0
+        duration = self.duration or (time.perf_counter() - self.start)
+        return "初回トークンまで：{:.2f}秒 / 処理時間：{:.2f}秒".format(ttft, duration)
 
 class ImageProcessor:
     @staticmethod
@@ -13,7 +341,12 @@ class ImageProcessor:
             if not os.path.isfile(image_input):
                 raise FileNotFoundError(f"指定されたファイルが見つかりません: {image_input}")
             with open(image_input, "rb") as file:
-                return base64.b64encode(file.read()).decode("utf-8")
+                data = file.read()
+            # Titan が受け付けるのは PNG / JPEG のみのため、それ以外（BMP など）は PNG に変換する
+            if not data.startswith(IMAGE_SIGNATURES):
+                with Image.open(io.BytesIO(data)) as image:
+                    return ImageProcessor.convert_image_to_base64(image)
+            return base64.b64encode(data).decode("utf-8")
         elif isinstance(image_input, Image.Image):
             buffer = io.BytesIO()
             image_input.save(buffer, format="PNG")
@@ -21,9 +354,63 @@ class ImageProcessor:
         else:
             raise ValueError("サポートされていない型です。str (ファイルパス) または PIL.Image.Image が必要です。")
 
+    @staticmethod
+    def resize_for_llm(image):
+        """Claude が縮小せずに扱える解像度（長辺・画素数の上限）まで縮小する"""
+        width, height = image.size
+        scale = min(1.0, LLM_IMAGE_MAX_EDGE / max(width, height), (LLM_IMAGE_MAX_PIXELS / (width * height)) ** 0.5)
+        if scale < 1.0:
+            image = image.resize((max(1, int(width * scale)), max(1, int(height * scale))), Image.LANCZOS)
+        return image
+
+    @staticmethod
+    def encode_for_llm(image_input):
+        """Claude に入力する画像を縮小・圧縮し、(media_type, Base64 文字列) を返す
+
+        透過のない画像は JPEG、透過のある画像は WebP で圧縮する。同じ内容の画像は
+        エンコード結果を再利用する（キーは画素データのハッシュ）。
+        """
+        if isinstance(image_input, str):
+            image_input = image_store.get_image(image_input)
+        elif not isinstance(image_input, Image.Image):
+            raise ValueError("サポートされていない型です。str (ファイルパス) または PIL.Image.Image が必要です。")
+        key = hashlib.blake2b(image_input.tobytes(), digest_size=16)
+        key.update(f"{image_input.mode}{image_input.size}".encode("utf-8"))
+        key = key.digest()
+        cached = _llm_images.get(key)
+        if cached is not None:
+            return cached
+
+        image = ImageProcessor.resize_for_llm(image_input)
+        buffer = io.BytesIO()
+        if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+            image.convert("RGBA").save(buffer, format="WEBP", quality=LLM_IMAGE_QUALITY)
+            media_type = "image/webp"
+        else:
+            image.convert("RGB").save(buffer, format="JPEG", quality=LLM_IMAGE_QUALITY, optimize=True)
+            media_type = "image/jpeg"
+        encoded = (media_type, base64.b64encode(buffer.getvalue()).decode("utf-8"))
+        _llm_images.put(key, encoded)
+        return encoded
+
+    @staticmethod
+    def image_content(image_input):
+        """Claude の Messages API に渡す画像のコンテンツブロックを作成する"""
+        media_type, data = ImageProcessor.encode_for_llm(image_input)
+        return {
+            "type": "image",
+            "source": {
+                "type": "base64",
+                "media_type": media_type,
+                "data": data
+            }
+        }
+
+_llm_images = image_store.LRUCache(int(os.environ.get("LLM_IMAGE_CACHE_ITEMS", DEFAULT_LLM_IMAGE_CACHE_ITEMS)))
+
 class BedrockAPI:
     def __init__(self):
-        self.client = boto3.client(service_name="bedrock-runtime", region_name=os.environ['region'])
+        self.client = get_client("bedrock-runtime")
 
     def proofread_desc_message(
         self, 
@@ -34,7 +421,8 @@ class BedrockAPI:
         top_p = 0.5,
         top_k = 10,
         stop_sequences = [],
-        modelId = "anthropic.claude-3-sonnet-20240229-v1:0"
+        modelId = "anthropic.claude-3-sonnet-20240229-v1:0",
+        stream = False
     ):
         content = []
 
@@ -77,12 +465,9 @@ class BedrockAPI:
             "messages": messages
         }
         
-        response = self.client.invoke_model(
-            body=json.dumps(body),
-            modelId=modelId,
-            accept="application/json",
-            contentType="application/json",
-        )
+        if stream:
+            return itertools.chain(["<"], invoke_model_stream(self.client, body, modelId))
+        response = invoke_model(self.client, body, modelId)
         response_body = json.loads(response.get("body").read())
         return "<" + response_body["content"][0]["text"]
 
@@ -96,7 +481,8 @@ class BedrockAPI:
         top_p = 0.5,
         top_k = 10,
         stop_sequences = [],
-        modelId = "anthropic.claude-3-sonnet-20240229-v1:0"
+        modelId = "anthropic.claude-3-sonnet-20240229-v1:0",
+        stream = False
     ):
         content = []
 
@@ -108,14 +494,7 @@ class BedrockAPI:
                 }
             )
             content.append(
-                {
-                    "type": "image",
-                    "source": {
-                        "type": "base64",
-                        "media_type": "image/jpeg",
-                        "data": ImageProcessor.convert_image_to_base64(item_image)
-                    }
-                }
+                ImageProcessor.image_content(item_image)
             )
         if item_desc is not None and len(item_desc) != 0:
             content.append(
@@ -149,12 +528,9 @@ class BedrockAPI:
             "messages": messages
         }
         
-        response = self.client.invoke_model(
-            body=json.dumps(body),
-            modelId=modelId,
-            accept="application/json",
-            contentType="application/json",
-        )
+        if stream:
+            return invoke_model_stream(self.client, body, modelId)
+        response = invoke_model(self.client, body, modelId)
         response_body = json.loads(response.get("body").read())
         return response_body["content"][0]["text"]
 
@@ -167,20 +543,14 @@ class BedrockAPI:
         top_p = 0.5,
         top_k = 10,
         stop_sequences = [],
-        modelId = "anthropic.claude-3-sonnet-20240229-v1:0"
+        modelId = "anthropic.claude-3-sonnet-20240229-v1:0",
+        stream = False
     ):
         content = []
 
         if item_image is not None:
             content.append(
-                {
-                    "type": "image",
-                    "source": {
-                        "type": "base64",
-                        "media_type": "image/jpeg",
-                        "data": ImageProcessor.convert_image_to_base64(item_image)
-                    }
-                }
+                ImageProcessor.image_content(item_image)
             )
         if item_desc is not None and len(item_desc) != 0:
             content.append(
@@ -207,12 +577,9 @@ class BedrockAPI:
             "messages": messages
         }
         
-        response = self.client.invoke_model(
-            body=json.dumps(body),
-            modelId=modelId,
-            accept="application/json",
-            contentType="application/json",
-        )
+        if stream:
+            return invoke_model_stream(self.client, body, modelId)
+        response = invoke_model(self.client, body, modelId)
         response_body = json.loads(response.get("body").read())
         return response_body["content"][0]["text"]
 
@@ -228,19 +595,13 @@ class BedrockAPI:
         top_p = 0.5,
         top_k = 10,
         stop_sequences = [],
-        modelId = "anthropic.claude-3-sonnet-20240229-v1:0"
+        modelId = "anthropic.claude-3-sonnet-20240229-v1:0",
+        stream = False
     ):
         content = []
         if left_image is not None:
             content.append(
-                {
-                    "type": "image",
-                    "source": {
-                        "type": "base64",
-                        "media_type": "image/jpeg",
-                        "data": ImageProcessor.convert_image_to_base64(left_image)
-                    }
-                }
+                ImageProcessor.image_content(left_image)
             )
         if left_text is not None and len(left_text) != 0:
             content.append(
@@ -252,14 +613,7 @@ class BedrockAPI:
         
         if right_image is not None:
             content.append(
-                {
-                    "type": "image",
-                    "source": {
-                        "type": "base64",
-                        "media_type": "image/jpeg",
-                        "data": ImageProcessor.convert_image_to_base64(right_image)
-                    }
-                }
+                ImageProcessor.image_content(right_image)
             )
             
         if right_text is not None and len(right_text) != 0:
@@ -287,16 +641,13 @@ class BedrockAPI:
             "messages": messages
         }
         
-        response = self.client.invoke_model(
-            body=json.dumps(body),
-            modelId=modelId,
-            accept="application/json",
-            contentType="application/json",
-        )
+        if stream:
+            return invoke_model_stream(self.client, body, modelId)
+        response = invoke_model(self.client, body, modelId)
         response_body = json.loads(response.get("body").read())
         return response_body["content"][0]["text"]
 
-    def get_vector_titan_multi_modal(self, image, text):
+    def get_vector_titan_multi_modal(self, image, text, max_retries=MAX_RETRIES):
         # MAX image size supported is 2048 * 2048 pixels
         if image is None and text is None:
             return []
@@ -306,22 +657,32 @@ class BedrockAPI:
         # You can specify either text or image or both
         body = {
             "embeddingConfig": {
-                "outputEmbeddingLength": 1024
+                "outputEmbeddingLength": TITAN_EMBEDDING_DIMENSION
             }
         }
         
         if text: 
-            body["inputText"] = text
+            body["inputText"] = embedding_cache.normalize_text(text)
         if image:
             body["inputImage"] = ImageProcessor.convert_image_to_base64(image)
 
-        response = self.client.invoke_model(
-            body=json.dumps(body),
-            modelId="amazon.titan-embed-image-v1",
-            accept="application/json",
-            contentType="application/json",
-        )
+        # 同じ入力のベクトルはキャッシュから返す
+        cache = embedding_cache.get_default_cache()
+        if cache is not None:
+            cache_key = embedding_cache.make_key(
+                TITAN_EMBEDDING_MODEL_ID,
+                TITAN_EMBEDDING_DIMENSION,
+                body.get("inputText"),
+                body.get("inputImage", "").encode("ascii"),
+            )
+            cached = cache.get(cache_key)
+            if cached is not None:
+                return cached.tolist()
+
+        response = invoke_model(self.client, body, TITAN_EMBEDDING_MODEL_ID, max_retries=max_retries)
         response_body = json.loads(response.get("body").read())
         embedding = response_body.get("embedding")
+        if cache is not None and embedding:
+            cache.put(cache_key, embedding)
         return embedding
     
\ No newline at end of file
@@ -0,0 +1,116 @@
+"""Titan Multimodal Embeddings のベクトルをディスクにキャッシュする
+
+キーはモデル ID・出力次元数・正規化済みの入力（テキスト、画像のバイト列）のハッシュで、
+同じ入力に対しては Bedrock を呼び出さずにベクトルを返す。
+SQLite に float32 の BLOB として保存し、頻繁に参照されるベクトルはメモリ上の LRU にも保持する。
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import unicodedata
+from collections import OrderedDict
+
+import numpy as np
+
+DEFAULT_CACHE_PATH = "cache/embeddings.sqlite3"
+DEFAULT_MEMORY_ITEMS = 4096
+
+def normalize_text(text):
+    """キャッシュキーと API 入力で共通に使うテキストの正規化"""
+    return unicodedata.normalize("NFC", text).strip()
+
+def make_key(model_id, dimension, text=None, image_bytes=None):
+    """入力内容からキャッシュキー（SHA-256）を作成する"""
+    h = hashlib.sha256()
+    h.update(f"{model_id}\0{dimension}\0".encode("utf-8"))
+    h.update(b"text\0")
+    if text:
+        h.update(text.encode("utf-8"))
+    h.update(b"\0image\0")
+    if image_bytes:
+        h.update(image_bytes)
+    return h.digest()
+
+class EmbeddingCache:
+    """SQLite とメモリ上の LRU による 2 段のベクトルキャッシュ"""
+    def __init__(self, path=DEFAULT_CACHE_PATH, memory_items=DEFAULT_MEMORY_ITEMS):
+        self.path = path
+        self.memory_items = memory_items
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Streamlit の複数セッション（スレッド）から共有するため、ロックで排他して 1 接続を使い回す
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (key BLOB PRIMARY KEY, vector BLOB NOT NULL)"
+        )
+        self._conn.commit()
+
+    def _remember(self, key, vector):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    def get(self, key):
+        """キャッシュされたベクトル（float32 の ndarray）を返す。存在しない場合は None"""
+        with self._lock:
+            vector = self._memory.get(key)
+            if vector is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return vector
+            row = self._conn.execute("SELECT vector FROM embeddings WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            vector = np.frombuffer(row[0], dtype=np.float32)
+            self._remember(key, vector)
+            self.disk_hits += 1
+            return vector
+
+    def put(self, key, vector):
+        vector = np.ascontiguousarray(vector, dtype=np.float32)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                (key, vector.tobytes()),
+            )
+            self._conn.commit()
+            self._remember(key, vector)
+
+    def stats(self):
+        """ヒット・ミスの件数を返す"""
+        with self._lock:
+            total = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.memory_hits + self.disk_hits) / total if total else 0.0,
+            }
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+def get_default_cache():
+    """プロセス内で共有するキャッシュを取得する。EMBEDDING_CACHE=off の場合は None"""
+    global _default_cache
+    if os.environ.get("EMBEDDING_CACHE", "on").lower() == "off":
+        return None
+    if _default_cache is None:
+        with _default_cache_lock:
+            if _default_cache is None:
+                _default_cache = EmbeddingCache(
+                    path=os.environ.get("EMBEDDING_CACHE_PATH", DEFAULT_CACHE_PATH),
+                    memory_items=int(os.environ.get("EMBEDDING_CACHE_MEMORY_ITEMS", DEFAULT_MEMORY_ITEMS)),
+                )
+    return _default_cache
@@ -0,0 +1,17 @@
+"""環境変数の読み込み（起動時に app.py から 1 回だけ呼び出す）"""
+import os
+
+from dotenv import load_dotenv
+
+_loaded = set()
+
+def load_env_if_exists(env_path='.env'):
+    """カレントディレクトリに .env ファイルが存在する場合に限り、環境変数を読み込む。
+
+    app.py は Streamlit の再実行のたびに実行されるため、同じファイルはプロセス内で 1 回だけ読み込む。
+    """
+    if env_path in _loaded:
+        return
+    if os.path.isfile(env_path):
+        load_dotenv(env_path)
+        _loaded.add(env_path)
@@ -0,0 +1,119 @@
+"""商品画像のサムネイルとデコード済み画像をキャッシュする
+
+画面表示にはあらかじめ作成した固定サイズのサムネイル（WebP）のバイト列を、Claude への入力には
+元画像をデコードした PIL Image を使い、それぞれを (パス, 更新時刻) をキーにした LRU キャッシュで
+全セッションから共有する。Streamlit の再実行のたびにディスクの読み込みとデコードが走らないようにする。
+"""
+import io
+import os
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+DEFAULT_THUMBNAIL_DIR = "cache/thumbnails"
+THUMBNAIL_SIZE = (384, 384)  # 長辺の最大ピクセル数（縦横比は保持する）
+THUMBNAIL_FORMAT = "WEBP"
+THUMBNAIL_QUALITY = 80
+DEFAULT_THUMBNAIL_ITEMS = 1024
+DEFAULT_IMAGE_ITEMS = 64  # デコード済みの元画像はサイズが大きいため少なめに保持する
+
+class LRUCache:
+    """スレッドセーフな LRU キャッシュ
+
+    max_bytes を指定した場合は、値（bytes）の合計サイズもその範囲に収める。
+    """
+    def __init__(self, max_items, max_bytes=None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def _size(self, value):
+        return len(value) if self.max_bytes is not None else 0
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            if key in self._items:
+                self._bytes -= self._size(self._items[key])
+            self._items[key] = value
+            self._bytes += self._size(value)
+            self._items.move_to_end(key)
+            while self._items and (
+                len(self._items) > self.max_items
+                or (self.max_bytes is not None and self._bytes > self.max_bytes)
+            ):
+                _, evicted = self._items.popitem(last=False)
+                self._bytes -= self._size(evicted)
+
+_thumbnails = LRUCache(int(os.environ.get("THUMBNAIL_CACHE_ITEMS", DEFAULT_THUMBNAIL_ITEMS)))
+_images = LRUCache(int(os.environ.get("IMAGE_CACHE_ITEMS", DEFAULT_IMAGE_ITEMS)))
+
+def thumbnail_dir():
+    return os.environ.get("THUMBNAIL_DIR", DEFAULT_THUMBNAIL_DIR)
+
+def thumbnail_path(image_path):
+    """元画像に対応するサムネイルのパス（サムネイルディレクトリ以下に元画像の相対パスで保存する）"""
+    relative = os.path.relpath(image_path)
+    if relative.startswith(os.pardir):
+        relative = os.path.abspath(image_path).lstrip(os.sep)
+    return os.path.join(thumbnail_dir(), relative + "." + THUMBNAIL_FORMAT.lower())
+
+def make_thumbnail(image):
+    """固定サイズに縮小したサムネイルを WebP のバイト列で返す"""
+    image = image.copy()
+    image.thumbnail(THUMBNAIL_SIZE)
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+    buffered = io.BytesIO()
+    image.save(buffered, format=THUMBNAIL_FORMAT, quality=THUMBNAIL_QUALITY)
+    return buffered.getvalue()
+
+def generate_thumbnail(image_path):
+    """サムネイルが無いか元画像より古い場合に作成し、サムネイルのバイト列を返す"""
+    path = thumbnail_path(image_path)
+    if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(image_path):
+        with open(path, 'rb') as f:
+            return f.read()
+    with Image.open(image_path) as image:
+        data = make_thumbnail(image)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return data
+
+def generate_thumbnails(image_paths, progress=None):
+    """商品登録時にまとめてサムネイルを作成する。progress には (完了件数, 全件数) を受け取る関数を指定できる"""
+    for i, image_path in enumerate(image_paths):
+        generate_thumbnail(image_path)
+        if progress:
+            progress(i + 1, len(image_paths))
+
+def get_thumbnail(image_path):
+    """画面表示用のサムネイル（WebP のバイト列）を取得する"""
+    key = (image_path, os.path.getmtime(image_path))
+    data = _thumbnails.get(key)
+    if data is None:
+        data = generate_thumbnail(image_path)
+        _thumbnails.put(key, data)
+    return data
+
+def get_image(image_path):
+    """Claude への入力用にデコード済みの元画像を取得する。戻り値は共有オブジェクトのため変更しないこと"""
+    key = (image_path, os.path.getmtime(image_path))
+    image = _images.get(key)
+    if image is None:
+        image = Image.open(image_path)
+        image.load()
+        _images.put(key, image)
+    return image
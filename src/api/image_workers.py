@@ -0,0 +1,233 @@
+"""CPU 負荷の高い画像処理（背景の削除・リサイズ・エンコード）を別プロセスで実行する
+
+Streamlit のスクリプトスレッドで rembg（alpha matting を含む）や PIL の処理を行うと、その間は
+GIL を取り合うため他のセッションの処理も遅くなる。ここでは処理をワーカープロセスのプールに渡し、
+画像の画素データは共有メモリ（multiprocessing.shared_memory）で受け渡してパイプでのコピーを省く。
+
+    mask, seconds = image_workers.remove_background(image)           # 同期（結果を待つ間は GIL を解放する）
+    mask, seconds = await image_workers.remove_background_async(image)  # asyncio から利用する場合
+
+IMAGE_WORKERS=0 の場合はプールを使わず、呼び出し元のスレッドで実行する。
+小さな画像のリサイズは共有メモリとプロセス間通信の往復より速いため、常に呼び出し元のスレッドで実行する。
+"""
+import asyncio
+import base64
+import io
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+
+import numpy as np
+from PIL import Image
+
+from api import background
+
+DEFAULT_MAX_WORKERS = 2
+DEFAULT_TIMEOUT_SECONDS = 300  # 初回の背景削除はモデルのダウンロードを含む
+INLINE_RESIZE_MAX_PIXELS = 4096 * 4096  # これ以下の画素数の画像はワーカーに渡さずにリサイズする
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def max_workers():
+    return int(os.environ.get("IMAGE_WORKERS", min(DEFAULT_MAX_WORKERS, os.cpu_count() or 1)))
+
+def timeout_seconds():
+    return float(os.environ.get("IMAGE_WORKER_TIMEOUT_SECONDS", DEFAULT_TIMEOUT_SECONDS))
+
+def _worker_init():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+def get_executor():
+    """プロセス内で共有するワーカープールを取得する。IMAGE_WORKERS=0 の場合は None"""
+    global _executor
+    if max_workers() <= 0:
+        return None
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                # Streamlit のサーバーはスレッドを使っているため、fork ではなく spawn で起動する
+                _executor = ProcessPoolExecutor(
+                    max_workers=max_workers(),
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_worker_init,
+                )
+    return _executor
+
+def _reset_executor(broken):
+    """ワーカーが異常終了して使えなくなったプールを破棄する（次の get_executor で作り直す）"""
+    global _executor
+    with _executor_lock:
+        if _executor is broken:
+            _executor = None
+    broken.shutdown(wait=False, cancel_futures=True)
+
+# --- 共有メモリでの画像の受け渡し ---
+
+class SharedImage:
+    """画素データを共有メモリに置いた画像。ワーカーにはメタデータ（名前・形状・モード）だけを渡す"""
+    def __init__(self, shape, mode):
+        self.shape = tuple(shape)
+        self.mode = mode
+        self.shm = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(self.shape))))
+
+    @classmethod
+    def from_image(cls, image):
+        if image.mode not in ("L", "RGB", "RGBA"):
+            image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+        array = np.asarray(image)
+        shared = cls(array.shape, image.mode)
+        np.ndarray(array.shape, dtype=np.uint8, buffer=shared.shm.buf)[:] = array
+        return shared
+
+    @property
+    def ref(self):
+        return (self.shm.name, self.shape, self.mode)
+
+    def to_image(self):
+        array = np.ndarray(self.shape, dtype=np.uint8, buffer=self.shm.buf)
+        image = Image.fromarray(array.copy())
+        del array
+        return image
+
+    def release(self):
+        self.shm.close()
+        self.shm.unlink()
+
+def _attach(name):
+    """ワーカー側で共有メモリを開く。解放は作成した側（unlink）が行う
+
+    Python 3.12 以前は開くだけでリソーストラッカーに登録されるが、spawn したワーカーは
+    親プロセスと同じトラッカーを使うため、二重登録にはならない。
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        return shared_memory.SharedMemory(name=name)
+
+def _read_shared(ref):
+    name, shape, mode = ref
+    shm = _attach(name)
+    try:
+        array = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+        image = Image.fromarray(array.copy())
+        del array
+    finally:
+        shm.close()
+    return image
+
+def _write_shared(ref, image):
+    name, shape, _ = ref
+    shm = _attach(name)
+    try:
+        array = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+        array[:] = np.asarray(image).reshape(shape)
+        del array
+    finally:
+        shm.close()
+
+# --- ワーカーで実行する処理（トップレベルの関数としてワーカーから import される） ---
+
+def _remove_background_job(src_ref, dst_ref, alpha_matting, model):
+    mask, elapsed = background.remove_background(_read_shared(src_ref), alpha_matting=alpha_matting, model=model)
+    _write_shared(dst_ref, mask.convert("L"))
+    return elapsed
+
+def _warm_up_job(model):
+    try:
+        background.warm_up(model)
+    except Exception as e:
+        logging.warning(f"rembg のウォームアップに失敗しました: {e}")
+
+def _resize_job(src_ref, dst_ref):
+    _, shape, _ = dst_ref
+    _write_shared(dst_ref, _read_shared(src_ref).resize((shape[1], shape[0]), Image.LANCZOS))
+
+def _encode_job(src_ref, format):
+    buffer = io.BytesIO()
+    _read_shared(src_ref).save(buffer, format=format)
+    return buffer.getvalue()
+
+# --- 呼び出し側の API ---
+
+def _run(job, image, args=(), dst_shape=None, dst_mode="L"):
+    """画像を共有メモリに置いてジョブを実行し、(結果, 出力画像) を返す。プールが無い場合はその場で実行する
+
+    dst_shape を指定した場合は出力用の共有メモリも確保し、ジョブには (入力, 出力, *args) を渡す。
+    ワーカーの異常終了（メモリ不足など）でプールが使えなくなった場合は、プールを作り直して 1 回だけ再実行する。
+    IMAGE_WORKER_TIMEOUT_SECONDS 以内に終わらない場合は TimeoutError を送出する。
+    """
+    executor = get_executor()
+    src = SharedImage.from_image(image)
+    dst = SharedImage(dst_shape, dst_mode) if dst_shape is not None else None
+    job_args = (src.ref, dst.ref, *args) if dst else (src.ref, *args)
+    try:
+        if executor is None:
+            result = job(*job_args)
+        else:
+            try:
+                result = executor.submit(job, *job_args).result(timeout=timeout_seconds())
+            except BrokenProcessPool:
+                logging.warning("画像処理のワーカープロセスが異常終了したため、プールを作り直して再実行します。")
+                _reset_executor(executor)
+                result = get_executor().submit(job, *job_args).result(timeout=timeout_seconds())
+        return result, dst.to_image() if dst else None
+    finally:
+        src.release()
+        if dst:
+            dst.release()
+
+def remove_background(image, alpha_matting=True, model=None):
+    """背景を削除したマスク画像（モード L）と、推論にかかった時間を返す"""
+    elapsed, mask = _run(_remove_background_job, image, (alpha_matting, model), (image.height, image.width))
+    return mask, elapsed
+
+def resize_to_fit(image, max_dimension):
+    """縦横比を維持したまま、長辺が max_dimension 以下になるよう縮小する"""
+    if image.width <= max_dimension and image.height <= max_dimension:
+        return image
+    scale = max_dimension / max(image.width, image.height)
+    width, height = max(1, int(image.width * scale)), max(1, int(image.height * scale))
+    channels = {"L": (), "RGB": (3,), "RGBA": (4,)}
+    mode = image.mode if image.mode in channels else ("RGBA" if "A" in image.getbands() else "RGB")
+    if image.width * image.height <= INLINE_RESIZE_MAX_PIXELS:
+        return image.convert(mode).resize((width, height), Image.LANCZOS)
+    _, resized = _run(_resize_job, image.convert(mode), (), (height, width) + channels[mode], mode)
+    return resized
+
+def encode_base64(image, format="PNG"):
+    """画像をエンコードして Base64 文字列にする"""
+    data, _ = _run(_encode_job, image, (format,))
+    return base64.b64encode(data).decode("utf-8")
+
+async def remove_background_async(image, alpha_matting=True, model=None):
+    return await asyncio.to_thread(remove_background, image, alpha_matting, model)
+
+async def resize_to_fit_async(image, max_dimension):
+    return await asyncio.to_thread(resize_to_fit, image, max_dimension)
+
+async def encode_base64_async(image, format="PNG"):
+    return await asyncio.to_thread(encode_base64, image, format)
+
+_warm_up_started = False
+
+def warm_up_in_background(model=None):
+    """ワーカープロセスを起動し、1 つのワーカーで rembg のモデルを読み込んでおく
+
+    初回はモデルのダウンロードを含むため、全ワーカーを塞がないよう 1 つのワーカーだけで行う
+    （モデルファイルは共有されるため、ほかのワーカーは初回の利用時に読み込むだけで済む）。
+    REMBG_WARMUP=off の場合は何もしない。IMAGE_WORKERS=0 の場合は自プロセスで読み込む。
+    """
+    global _warm_up_started
+    if _warm_up_started or os.environ.get("REMBG_WARMUP", "on").lower() == "off":
+        return
+    _warm_up_started = True
+    executor = get_executor()
+    if executor is None:
+        background.warm_up_in_background(model)
+        return
+    executor.submit(_warm_up_job, model)
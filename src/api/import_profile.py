@@ -0,0 +1,92 @@
+"""各ページの import にかかる時間を python -X importtime で計測する
+
+ページのスクリプトを実行せずに、トップレベルの import 文だけを別プロセスで実行して計測する。
+Streamlit のサーバーでは app.py の import は起動時に済んでいるため、各ページは app.py の import を
+済ませた後の差分（そのページを開いたときに追加で読み込まれる分）を計測する。
+lazy.module で遅延読み込みにしたモジュールは、ページを開いた時点では読み込まれないため含まれない。
+
+    cd src
+    python -m api.import_profile
+    python -m api.import_profile --top 10 titan-image-inpainter/app.py
+"""
+import argparse
+import ast
+import subprocess
+import sys
+import tomllib
+
+PAGES_TOML = ".streamlit/pages_sections.toml"
+
+def list_pages(pages_toml=PAGES_TOML):
+    """起動スクリプト（先頭）と、ナビゲーションに登録されたページのパスを取得する"""
+    with open(pages_toml, 'rb') as f:
+        pages = tomllib.load(f).get("pages", [])
+    return ["app.py"] + [page["path"] for page in pages if "path" in page]
+
+def top_level_imports(script_path):
+    """スクリプトのトップレベルの import 文をソースコードとして取り出す"""
+    with open(script_path, 'r', encoding="utf-8") as f:
+        source = f.read()
+    tree = ast.parse(source)
+    return "\n".join(
+        ast.get_source_segment(source, node)
+        for node in tree.body
+        if isinstance(node, (ast.Import, ast.ImportFrom))
+    )
+
+MARKER = "--- import_profile ---"
+
+def parse_importtime(stderr):
+    """-X importtime の出力を (モジュール名, 自身の時間[us], 累積時間[us], 階層) のリストにする"""
+    rows = []
+    if MARKER in stderr:
+        stderr = stderr.split(MARKER, 1)[1]
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        depth = (len(name) - len(name.lstrip())) // 2
+        rows.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return rows
+
+def profile_imports(code, baseline=""):
+    """別プロセスで baseline の import を済ませてから code の import を実行し、合計時間[ms] と計測結果を返す"""
+    start_code = f"\nimport sys as _sys, time as _t; _sys.stderr.write({MARKER!r} + '\\n'); _s = _t.perf_counter()\n"
+    end_code = "\nprint((_t.perf_counter() - _s) * 1000)"
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", baseline + start_code + code + end_code],
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    return float(result.stdout.strip().splitlines()[-1]), parse_importtime(result.stderr)
+
+def main():
+    parser = argparse.ArgumentParser(description="各ページのトップレベルの import にかかる時間を計測します。")
+    parser.add_argument("pages", nargs="*", help="計測するスクリプト (デフォルト: app.py と pages_sections.toml の全ページ)")
+    parser.add_argument("--top", type=int, default=5, help="ページごとに表示する時間のかかったモジュール数")
+    args = parser.parse_args()
+
+    try:
+        baseline = top_level_imports("app.py")
+        startup_ms, _ = profile_imports(baseline)
+        print(f"app.py（起動時）: {startup_ms:.1f} ms")
+    except Exception as e:
+        print(f"app.py: 計測できませんでした ({e})")
+        return
+
+    for page in args.pages or list_pages()[1:]:
+        try:
+            total_ms, rows = profile_imports(top_level_imports(page), baseline)
+        except Exception as e:
+            print(f"{page}: 計測できませんでした ({e})")
+            continue
+        print(f"{page}: {total_ms:.1f} ms")
+        # 直接 import されたトップレベルのパッケージを累積時間の降順に表示する
+        packages = sorted((row for row in rows if row[3] == 0), key=lambda row: row[2], reverse=True)
+        for name, _, cumulative_us, _ in packages[:args.top]:
+            print(f"    {cumulative_us / 1000:>8.1f} ms  {name}")
+
+if __name__ == "__main__":
+    main()
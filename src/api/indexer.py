@@ -0,0 +1,214 @@
+"""商品データを一括でベクトル化し、FAISS インデックスを作成する
+
+Streamlit の「初期化 - 商品データ登録」から利用するほか、以下のように CLI からも実行できる。
+
+    cd src
+    region=us-west-2 python -m api.indexer --store store
+"""
+import argparse
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import faiss
+import numpy as np
+
+from api import catalog, common, embedding_cache, env, image_store, vector_store
+
+IMAGE_EXTENSIONS = (".jpg", ".png", ".bmp")
+
+DEFAULT_MAX_WORKERS = 8  # Bedrock への同時リクエスト数の上限
+DEFAULT_BATCH_SIZE = 256  # FAISS へ一括登録する件数
+MAX_RETRIES = 8  # スロットリングが続いた場合に同時実行数を下げて再試行する回数
+
+def list_image_files(dir_path):
+    """ディレクトリ内の画像ファイルのパスをファイル名順に取得する"""
+    files = sorted(f for f in os.listdir(dir_path) if f.endswith(IMAGE_EXTENSIONS))
+    return [os.path.join(dir_path, f) for f in files]
+
+class AdaptiveThrottle:
+    """同時実行数を AIMD（加算増加・乗算減少）で調整するスロットル
+
+    スロットリングが発生すると同時実行数を半分にし、成功が続くと 1 ずつ戻す。
+    """
+    def __init__(self, max_concurrency, min_concurrency=1):
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.limit = max_concurrency
+        self._in_flight = 0
+        self._successes = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self._in_flight >= self.limit:
+                self._cond.wait()
+            self._in_flight += 1
+
+    def release(self, throttled=False):
+        with self._cond:
+            self._in_flight -= 1
+            if throttled:
+                self.limit = max(self.min_concurrency, self.limit // 2)
+                self._successes = 0
+            else:
+                self._successes += 1
+                if self._successes >= self.limit and self.limit < self.max_concurrency:
+                    self.limit += 1
+                    self._successes = 0
+            self._cond.notify_all()
+
+class BulkEmbedder:
+    """Titan Multimodal Embeddings でまとめてベクトル化する"""
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS, bedrock_api=None):
+        self.max_workers = max_workers
+        self.bedrock_api = bedrock_api or common.BedrockAPI()
+        self.throttle = AdaptiveThrottle(max_workers)
+
+    def _embed_one(self, image, text):
+        # スロットリング時のリトライはここで行い、同時実行数の調整に反映する（api.common 側ではリトライしない）
+        for attempt in range(MAX_RETRIES + 1):
+            self.throttle.acquire()
+            try:
+                vector = self.bedrock_api.get_vector_titan_multi_modal(image, text, max_retries=0)
+            except Exception as e:
+                throttled = common.is_throttling_error(e)
+                self.throttle.release(throttled=throttled)
+                if not throttled or attempt == MAX_RETRIES:
+                    raise
+                time.sleep(common.backoff_seconds(attempt))
+                continue
+            self.throttle.release()
+            return vector
+
+    def embed(self, inputs):
+        """(image, text) のリストをベクトル化し、入力順の L2 正規化済み float32 行列で返す"""
+        matrix = np.empty((len(inputs), common.TITAN_EMBEDDING_DIMENSION), dtype=np.float32)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for i, vector in enumerate(executor.map(lambda x: self._embed_one(*x), inputs)):
+                matrix[i] = vector
+        return vector_store.normalize_vectors(matrix)
+
+def init_index():
+    # IndexFlatIP : コサイン類似度
+    return faiss.IndexFlatIP(common.TITAN_EMBEDDING_DIMENSION)
+
+def add_batches(embedder, index, ref, inputs, names, batch_size=DEFAULT_BATCH_SIZE, progress=None):
+    """バッチ単位でベクトル化し、バッチごとに 1 回だけ FAISS に登録する
+
+    学習が必要なインデックス（IVF）の場合は、全件をベクトル化して学習してから登録する。
+    """
+    matrices = []
+    for start in range(0, len(inputs), batch_size):
+        matrix = embedder.embed(inputs[start:start + batch_size])
+        if index.is_trained:
+            vector_store.train_index(index, matrix)
+            index.add(matrix)
+        else:
+            matrices.append(matrix)
+        if progress:
+            progress(min(start + batch_size, len(inputs)), len(inputs))
+    if matrices:
+        vector_store.train_index(index, np.vstack(matrices))
+        for matrix in matrices:
+            index.add(matrix)
+    for i, name in enumerate(names):
+        ref[i] = name
+
+def build_store_index(save_dir, max_workers=DEFAULT_MAX_WORKERS, batch_size=DEFAULT_BATCH_SIZE, progress=None, index_params=None):
+    """ストアの商品画像と商品説明文をベクトル化し、画像・テキストのインデックスを作成する
+
+    progress には (ラベル, 完了件数, 全件数) を受け取る関数を指定できる。
+    index_params でインデックスの種類（flat / hnsw / ivf_flat / ivf_pq）とパラメータを指定できる。
+    ID マップは行番号順の image_name の配列で返す。戻り値の item_list は商品リストのカタログ、最後は件数に合わせて調整した実際のパラメータ。
+    """
+    embedder = BulkEmbedder(max_workers=max_workers)
+
+    image_paths = list_image_files(save_dir)
+    item_list = catalog.load_catalog(save_dir)
+    params = vector_store.resolve_index_params(index_params or {}, min(len(image_paths), len(item_list)))
+
+    index_img, ref_img = vector_store.create_index(common.TITAN_EMBEDDING_DIMENSION, params), {}
+    add_batches(
+        embedder, index_img, ref_img,
+        [(path, None) for path in image_paths],
+        [os.path.basename(path) for path in image_paths],
+        batch_size,
+        (lambda done, total: progress("image", done, total)) if progress else None,
+    )
+
+    # 画面表示用のサムネイルも登録時に作成しておく
+    image_store.generate_thumbnails(
+        image_paths,
+        (lambda done, total: progress("thumbnail", done, total)) if progress else None,
+    )
+
+    index_txt, ref_txt = vector_store.create_index(common.TITAN_EMBEDDING_DIMENSION, params), {}
+    if len(item_list) > 0:
+        add_batches(
+            embedder, index_txt, ref_txt,
+            [(None, desc) for desc in item_list.item_descs],
+            list(item_list.image_names),
+            batch_size,
+            (lambda done, total: progress("text", done, total)) if progress else None,
+        )
+    return index_img, vector_store.to_id_array(ref_img), index_txt, vector_store.to_id_array(ref_txt), item_list, params
+
+def save_store_index(store_name, index_txt, ref_txt, index_img, ref_img, index_dir="index", params=None):
+    os.makedirs(index_dir, exist_ok=True)
+    paths = vector_store.index_paths(store_name, index_dir)
+    # 検索パラメータはインデックスより先に保存し、再読み込み時に新しい値が使われるようにする
+    vector_store.save_index_params(store_name, params or vector_store.DEFAULT_INDEX_PARAMS, index_dir)
+    vector_store.replace_file(paths["txt_index"], lambda path: faiss.write_index(index_txt, path))
+    vector_store.replace_file(paths["img_index"], lambda path: faiss.write_index(index_img, path))
+    vector_store.save_id_map(paths["txt_ids"], ref_txt)
+    vector_store.save_id_map(paths["img_ids"], ref_img)
+
+def main():
+    parser = argparse.ArgumentParser(description="商品データを一括でベクトル化し、FAISS インデックスを作成します。")
+    parser.add_argument("--store", required=True, help="ストア名 (例: store, store_food, store_living)")
+    parser.add_argument("--source-dir", help="商品データのディレクトリ (デフォルト: store_source/<store>)")
+    parser.add_argument("--index-dir", default="index", help="インデックスの保存先")
+    parser.add_argument("--workers", type=int, default=DEFAULT_MAX_WORKERS, help="Bedrock への最大同時リクエスト数")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="FAISS へ一括登録する件数")
+    parser.add_argument("--index-type", choices=vector_store.INDEX_TYPES, default="flat", help="インデックスの種類")
+    parser.add_argument("--nlist", type=int, default=vector_store.DEFAULT_INDEX_PARAMS["nlist"], help="IVF のクラスタ数")
+    parser.add_argument("--pq-m", type=int, default=vector_store.DEFAULT_INDEX_PARAMS["pq_m"], help="PQ のサブベクトル数")
+    parser.add_argument("--hnsw-m", type=int, default=vector_store.DEFAULT_INDEX_PARAMS["hnsw_m"], help="HNSW のリンク数")
+    parser.add_argument("--nprobe", type=int, default=vector_store.DEFAULT_INDEX_PARAMS["nprobe"], help="IVF の検索時に探索するクラスタ数")
+    parser.add_argument("--ef-search", type=int, default=vector_store.DEFAULT_INDEX_PARAMS["efSearch"], help="HNSW の検索時の探索幅")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    env.load_env_if_exists()
+    save_dir = args.source_dir or os.path.join("store_source", args.store)
+
+    start = time.perf_counter()
+    index_img, ref_img, index_txt, ref_txt, _, params = build_store_index(
+        save_dir,
+        max_workers=args.workers,
+        batch_size=args.batch_size,
+        progress=lambda label, done, total: logging.info(f"{label}: {done}/{total}"),
+        index_params={
+            "index_type": args.index_type,
+            "nlist": args.nlist,
+            "pq_m": args.pq_m,
+            "hnsw_m": args.hnsw_m,
+            "nprobe": args.nprobe,
+            "efSearch": args.ef_search,
+        },
+    )
+    save_store_index(args.store, index_txt, ref_txt, index_img, ref_img, args.index_dir, params)
+    logging.info(f"インデックスのパラメータ: {params}")
+    logging.info(
+        f"画像 {index_img.ntotal} 件、テキスト {index_txt.ntotal} 件を登録しました。"
+        f"処理時間：{time.perf_counter() - start:.2f}秒"
+    )
+    cache = embedding_cache.get_default_cache()
+    if cache is not None:
+        logging.info(f"埋め込みキャッシュ: {cache.stats()}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""インペインティング（マスク以外の部分の画像生成）の共通処理
+
+titan-image-inpainter / design-generation の画面と、一括処理の CLI（api.batch_inpaint）で共有する。
+"""
+import base64
+import io
+import json
+import logging
+
+from PIL import Image
+
+from api import common, image_workers, masking
+
+TITAN_IMAGE_MODEL_ID = "amazon.titan-image-generator-v1"
+SDXL_MODEL_ID = "stability.stable-diffusion-xl-v1"
+TRANSLATE_REGION = "ap-northeast-1"
+
+class TranslationError(Exception):
+    """Translateでエラーが発生した場合のカスタム例外クラス"""
+    def __init__(self, message="Translateでエラーが発生しました。", errors=None):
+        super().__init__(message)
+        self.errors = errors
+
+class Translator:
+    def __init__(self, region_name=TRANSLATE_REGION):
+        self.client = common.get_client("translate", region_name=region_name)
+
+    def translate_text(self, text, source_language_code='ja', target_language_code='en'):
+        """テキストを翻訳する"""
+        try:
+            result = self.client.translate_text(Text=text, SourceLanguageCode=source_language_code, TargetLanguageCode=target_language_code)
+            return result.get('TranslatedText')
+        except Exception as e:
+            logging.error(f"翻訳中にエラーが発生しました: {e}")
+            raise TranslationError(errors=e)
+
+def create_mask(image, invert=False, alpha_matting=True):
+    """背景を削除してインペインティング用の 2 値のマスクを作成する
+
+    戻り値は (2 値化したマスク, rembg が出力したマスク, 推論時間[秒])。
+    invert=False は物体の部分を白、invert=True は物体の部分を黒にする。
+    """
+    bg_removed_image, seconds = image_workers.remove_background(image, alpha_matting=alpha_matting)
+    return masking.process_mask(bg_removed_image, invert=invert), bg_removed_image, seconds
+
+def build_edit_image_body(model_id, task_type, translated_prompt, negative_prompt, image, mask_image=None, num_images=1, seed=0):
+    """画像編集（インペインティング等）のリクエストボディを作成する。プロンプトは英訳済みのものを渡す"""
+    if model_id == TITAN_IMAGE_MODEL_ID:
+        body = {
+            "taskType": task_type.upper(),
+            "inPaintingParams": {
+                "text": translated_prompt,
+                "negativeText": negative_prompt,
+                "image": image_workers.encode_base64(image),
+            },
+            "imageGenerationConfig": {
+                "numberOfImages": num_images,
+                "quality": "standard",
+                "cfgScale": 8.0,
+                "seed": seed,
+            }
+        }
+        if mask_image:
+            body["inPaintingParams"]["maskImage"] = image_workers.encode_base64(mask_image)
+        return body
+    if model_id == SDXL_MODEL_ID:
+        return {
+            "text_prompts": [
+                {
+                    "text": translated_prompt,
+                    # "weight": float
+                }
+            ],
+            "init_image" : image_workers.encode_base64(image),
+            "mask_source" : "MASK_IMAGE_BLACK",
+            "mask_image" : image_workers.encode_base64(mask_image),
+            "cfg_scale": 8.0,
+            # "clip_guidance_preset": string,
+            # "sampler": string,
+            "samples" : 1,
+            "seed": seed,
+            # "steps": int, #defalut 30
+            "style_preset": "photographic",
+                # 3d-model, analog-film, anime, cinematic, comic-book, digital-art, enhance, fantasy-art, isometric, line-art, low-poly, modeling-compound, neon-punk, origami, photographic, pixel-art, tile-texture
+            # "extras" : json object
+        }
+    raise ValueError(f"サポートされていないモデルです: {model_id}")
+
+def decode_images(model_id, response_body):
+    """レスポンスから生成された画像を取り出す"""
+    if model_id == SDXL_MODEL_ID:
+        return [Image.open(io.BytesIO(base64.b64decode(response_body["artifacts"][0]["base64"])))]
+    return [Image.open(io.BytesIO(base64.b64decode(base64_image))) for base64_image in response_body.get("images")]
+
+def invoke_edit_image(client, model_id, body):
+    """画像編集のモデルを呼び出し、生成された画像のリストを返す"""
+    response = common.invoke_model(client, body, model_id)
+    return decode_images(model_id, json.loads(response.get("body").read()))
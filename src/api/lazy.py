@@ -0,0 +1,35 @@
+"""重いモジュールを初回の利用時まで読み込まないためのプロキシ
+
+Streamlit のページは表示のたびにスクリプト全体が実行されるため、ページの先頭で rembg や
+langchain を import すると、ボタンを押さずにページを開いただけでも読み込みを待つことになる。
+
+    rembg = lazy.module("rembg")
+    rembg.remove(image)  # ここで初めて rembg を import する
+"""
+import importlib
+
+class LazyModule:
+    """属性に初めてアクセスしたときにモジュールを import する"""
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            # import はインタプリタのロックで排他されるため、複数セッションから同時に呼ばれても 1 回だけ読み込まれる
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    @property
+    def is_loaded(self):
+        return self._module is not None
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        state = "loaded" if self.is_loaded else "not loaded"
+        return f"<lazy module '{self._name}' ({state})>"
+
+def module(name):
+    return LazyModule(name)
@@ -0,0 +1,182 @@
+"""LP の生成物（画像・HTML）をセッションごとのディレクトリに保存する
+
+Streamlit の静的ファイル配信（static/）は全セッションで共有されるため、生成物は
+static/<セッション ID>/ 以下に保存し、他の利用者の生成物を上書き・削除しないようにする。
+画像は内容のハッシュをファイル名にして保存する（同じ画像は 1 回だけ書き込む）。
+最終更新から LP_ASSET_TTL_SECONDS を過ぎたセッションのディレクトリは collect_garbage で削除する。
+
+    assets = lp_assets.SessionAssets(session_id)
+    filename, data = assets.save_image(image)
+    html = lp_assets.rewrite_image_sources(html, {"image_9e3d82f": assets.url(filename)})
+    archive = lp_assets.get_archive(build_id, lambda: [("index.html", html.encode("utf-8")), (filename, data)])
+"""
+import hashlib
+import io
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+
+from api import image_store
+
+STATIC_DIR = "static"
+STATIC_URL = "./app/static"  # enableStaticServing で配信される static/ の URL
+DEFAULT_TTL_SECONDS = 3600
+GC_INTERVAL_SECONDS = 300  # 期限切れのディレクトリを確認する間隔
+STORED_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp", ".gif", ".zip")  # ZIP に無圧縮で格納する形式
+DEFAULT_ARCHIVE_CACHE_ITEMS = 16
+DEFAULT_ARCHIVE_CACHE_MB = 64  # ZIP は画像を含むため、件数に加えて合計サイズでも上限を設ける
+
+_archives = image_store.LRUCache(
+    int(os.environ.get("LP_ARCHIVE_CACHE_ITEMS", DEFAULT_ARCHIVE_CACHE_ITEMS)),
+    max_bytes=int(os.environ.get("LP_ARCHIVE_CACHE_MB", DEFAULT_ARCHIVE_CACHE_MB)) * 1024 * 1024,
+)
+
+_gc_lock = threading.Lock()
+_last_gc = 0.0
+
+def ttl_seconds():
+    return int(os.environ.get("LP_ASSET_TTL_SECONDS", DEFAULT_TTL_SECONDS))
+
+def new_session_id():
+    return uuid.uuid4().hex
+
+def new_build_id():
+    return uuid.uuid4().hex[:12]
+
+def write_file(path, data):
+    """一時ファイルに書き込んでから置き換える（同じファイルを複数のスレッドが書き込んでも壊れないようにする）"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+class SessionAssets:
+    """1 セッション分の生成物の保存先（static/<session_id>/）"""
+    def __init__(self, session_id, static_dir=STATIC_DIR, static_url=STATIC_URL):
+        if not re.fullmatch(r"[0-9a-zA-Z_-]+", session_id):
+            raise ValueError(f"セッション ID に使用できない文字が含まれています: {session_id}")
+        self.session_id = session_id
+        self.dir = os.path.join(static_dir, session_id)
+        self.base_url = f"{static_url}/{session_id}"
+        # 作成直後（書き込み前）のディレクトリが期限切れとして削除されないよう、更新時刻を現在にする
+        self.touch()
+
+    def path(self, filename):
+        return os.path.join(self.dir, filename)
+
+    def url(self, filename):
+        return f"{self.base_url}/{filename}"
+
+    def touch(self):
+        """TTL の起点（ディレクトリの更新時刻）を現在時刻にする"""
+        os.makedirs(self.dir, exist_ok=True)
+        os.utime(self.dir)
+
+    def save_bytes(self, data, extension):
+        """内容のハッシュをファイル名にして保存し、ファイル名を返す。同じ内容のファイルがあれば書き込まない"""
+        filename = hashlib.blake2b(data, digest_size=16).hexdigest() + extension
+        path = self.path(filename)
+        if not os.path.exists(path):
+            os.makedirs(self.dir, exist_ok=True)
+            write_file(path, data)
+        self.touch()
+        return filename
+
+    def save_image(self, image, format="PNG"):
+        """画像を保存し、(ファイル名, エンコードしたバイト列) を返す"""
+        buffer = io.BytesIO()
+        image.save(buffer, format=format)
+        data = buffer.getvalue()
+        return self.save_bytes(data, "." + format.lower()), data
+
+    def save_html(self, build_id, html):
+        """ビルドごとの HTML を保存し、ファイル名を返す"""
+        filename = f"lp_{build_id}.html"
+        os.makedirs(self.dir, exist_ok=True)
+        write_file(self.path(filename), html.encode("utf-8"))
+        self.touch()
+        return filename
+
+def compress_type(arcname):
+    """圧縮済みの形式（PNG など）は再圧縮しても小さくならないため、無圧縮で格納する"""
+    return zipfile.ZIP_STORED if os.path.splitext(arcname)[1].lower() in STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+
+def build_zip(entries):
+    """(アーカイブ内の名前, バイト列またはファイルのパス) のリストから ZIP をメモリ上に作成し、バイト列を返す
+
+    生成直後のバイト列を渡せば、ディスクから読み直さずに作成できる。
+    """
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        for arcname, source in entries:
+            if isinstance(source, bytes):
+                info = zipfile.ZipInfo(arcname, date_time=time.localtime()[:6])
+                info.compress_type = compress_type(arcname)
+                archive.writestr(info, source)
+            else:
+                archive.write(source, arcname, compress_type=compress_type(arcname))
+    return buffer.getvalue()
+
+def get_archive(build_id, entries):
+    """ビルドごとの ZIP を返す。作成済みでなければ entries()（build_zip に渡すリストを返す関数）から作成する
+
+    ダウンロードボタンを押した後の再実行では、作成済みの ZIP をそのまま使う。
+    """
+    archive = _archives.get(build_id)
+    if archive is None:
+        archive = build_zip(entries())
+        # 上限を超える ZIP はキャッシュせず、ほかのビルドの ZIP を追い出さない
+        if len(archive) <= _archives.max_bytes:
+            _archives.put(build_id, archive)
+    return archive
+
+def rewrite_image_sources(html, sources):
+    """HTML 内の画像の参照（./app/static/<画像名>.png など）を、画像名 -> URL の対応に従って書き換える
+
+    対応がない画像の img タグは削除する（生成に失敗した画像）。
+    """
+    def replace(match):
+        url = sources.get(match.group(2))
+        if url is None:
+            return ""
+        return match.group(0).replace(match.group(1), url)
+    return re.sub(r'<img[^>]*?["\']((?:[^"\']*/)?(image_[0-9a-zA-Z-]+)\.png)["\'][^>]*>', replace, html)
+
+def collect_garbage(static_dir=STATIC_DIR, ttl=None, force=False):
+    """最終更新から ttl 秒を過ぎたセッションのディレクトリを削除し、削除した数を返す
+
+    force=False の場合は GC_INTERVAL_SECONDS に 1 回だけ確認する。
+    """
+    global _last_gc
+    ttl = ttl_seconds() if ttl is None else ttl
+    now = time.time()
+    with _gc_lock:
+        if not force and now - _last_gc < GC_INTERVAL_SECONDS:
+            return 0
+        _last_gc = now
+    removed = 0
+    if not os.path.isdir(static_dir):
+        return removed
+    for entry in os.scandir(static_dir):
+        if not entry.is_dir(follow_symlinks=False):
+            continue
+        try:
+            if now - entry.stat().st_mtime > ttl:
+                shutil.rmtree(entry.path)
+                removed += 1
+        except FileNotFoundError:
+            continue
+    if removed:
+        logging.info(f"期限切れの LP の生成物を削除しました: {removed} セッション")
+    return removed
@@ -0,0 +1,99 @@
+"""マスク画像の 2 値化と整形
+
+rembg が出力したマスク（グレースケール）を、Titan / SDXL のインペインティングに渡すマスクに変換する。
+2 値化は 256 要素のルックアップテーブルで一括して行い、膨張・収縮・穴埋め・ぼかしは OpenCV で
+画像全体に対してまとめて処理する（画素ごとの Python の関数呼び出しは行わない）。
+2 値化のみの場合は PIL Image のまま変換し、NumPy 配列との相互変換（画像のコピー）を省く。
+
+    mask = masking.process_mask(rembg_mask, invert=True, dilate_radius=4, fill=True)
+"""
+import numpy as np
+from PIL import Image
+
+from api import lazy
+
+cv2 = lazy.module("cv2")
+
+THRESHOLD = 128  # 2 値化の閾値
+
+def to_array(image):
+    """PIL Image または配列を 8bit グレースケールの配列にする"""
+    if isinstance(image, Image.Image):
+        if image.mode != "L":
+            image = image.convert("L")
+        return np.asarray(image)
+    array = np.asarray(image)
+    if array.ndim == 3:
+        array = array[..., 0]
+    return array.astype(np.uint8, copy=False)
+
+def threshold_lut(threshold=THRESHOLD, invert=False):
+    """2 値化のルックアップテーブル
+
+    invert=False: threshold 以上を 255、未満を 0 にする（物体の部分が白）
+    invert=True: threshold を超える画素を 0、それ以外を 255 にする（物体の部分が黒）
+    """
+    values = np.arange(256)
+    keep = values > threshold if invert else values >= threshold
+    return np.where(keep != invert, 255, 0).astype(np.uint8)
+
+def binarize(mask, threshold=THRESHOLD, invert=False):
+    """配列として 2 値化する"""
+    return cv2.LUT(to_array(mask), threshold_lut(threshold, invert))
+
+def binarize_image(mask, threshold=THRESHOLD, invert=False):
+    """PIL Image のまま 2 値化する"""
+    if mask.mode != "L":
+        mask = mask.convert("L")
+    return mask.point(threshold_lut(threshold, invert).tolist())
+
+def _kernel(radius):
+    return cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2 * radius + 1, 2 * radius + 1))
+
+def dilate(mask, radius):
+    """白い領域を radius ピクセル広げる"""
+    return cv2.dilate(mask, _kernel(radius)) if radius > 0 else mask
+
+def erode(mask, radius):
+    """白い領域を radius ピクセル狭める"""
+    return cv2.erode(mask, _kernel(radius)) if radius > 0 else mask
+
+def fill_holes(mask):
+    """白い領域の内側にある黒い穴を塗りつぶす（画像の端とつながっていない黒い領域を白にする）"""
+    height, width = mask.shape
+    padded = np.zeros((height + 2, width + 2), dtype=np.uint8)
+    padded[1:-1, 1:-1] = mask
+    # 外周から黒い領域を塗りつぶし、塗られなかった黒い画素を穴とみなす
+    flood_mask = np.zeros((height + 4, width + 4), dtype=np.uint8)
+    cv2.floodFill(padded, flood_mask, (0, 0), 255)
+    holes = padded[1:-1, 1:-1] == 0
+    filled = mask.copy()
+    filled[holes] = 255
+    return filled
+
+def feather(mask, radius):
+    """境界を radius ピクセル程度ぼかす（グレースケールのマスクになる）"""
+    if radius <= 0:
+        return mask
+    size = 2 * radius + 1
+    return cv2.GaussianBlur(mask, (size, size), radius / 2)
+
+def process_mask(mask, threshold=THRESHOLD, invert=False, dilate_radius=0, erode_radius=0, fill=False, feather_radius=0):
+    """2 値化・穴埋め・膨張・収縮・ぼかしを順に適用し、PIL Image（モード L）で返す
+
+    穴埋めと膨張・収縮は物体の部分（rembg のマスクで白い部分）に対して行う。
+    """
+    if not (fill or dilate_radius or erode_radius or feather_radius) and isinstance(mask, Image.Image):
+        return binarize_image(mask, threshold, invert)
+    array = binarize(mask, threshold, invert)
+    if fill or dilate_radius or erode_radius:
+        # 反転している場合は、物体の部分が白になるよう一度戻してから整形する
+        if invert:
+            array = cv2.bitwise_not(array)
+        if fill:
+            array = fill_holes(array)
+        array = erode(dilate(array, dilate_radius), erode_radius)
+        if invert:
+            array = cv2.bitwise_not(array)
+    array = feather(array, feather_radius)
+    return Image.fromarray(array)
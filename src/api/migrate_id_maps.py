@@ -0,0 +1,37 @@
+"""旧形式（行番号をキーとする JSON）の ID マップを .ids.npy に変換する
+
+    cd src
+    python -m api.migrate_id_maps --index-dir index
+"""
+import argparse
+import glob
+import os
+
+import numpy as np
+
+from api import vector_store
+
+def migrate_id_map(json_path, remove=False):
+    """JSON の ID マップを FAISS の行番号順の文字列配列として保存する"""
+    id_map = vector_store.to_id_array(vector_store.read_legacy_id_map(json_path))
+    ids_path = json_path[:-len(".json")] + ".ids.npy"
+    vector_store.save_id_map(ids_path, id_map)
+    # 変換結果を読み直して一致を確認してから旧ファイルを削除する
+    if not np.array_equal(np.load(ids_path, mmap_mode="r"), id_map):
+        raise RuntimeError(f"変換結果が一致しません: {json_path}")
+    if remove:
+        os.remove(json_path)
+    return ids_path, len(id_map)
+
+def main():
+    parser = argparse.ArgumentParser(description="JSON の ID マップを .ids.npy に変換します。")
+    parser.add_argument("--index-dir", default="index", help="インデックスの保存先")
+    parser.add_argument("--remove", action="store_true", help="変換後に JSON を削除する")
+    args = parser.parse_args()
+
+    for path in sorted(glob.glob(os.path.join(args.index_dir, "*_txt.json")) + glob.glob(os.path.join(args.index_dir, "*_img.json"))):
+        ids_path, n = migrate_id_map(path, args.remove)
+        print(f"{path} -> {ids_path}: {n} 件")
+
+if __name__ == "__main__":
+    main()
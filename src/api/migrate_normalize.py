@@ -0,0 +1,42 @@
+"""既存の .index ファイルのベクトルを L2 正規化して書き直す
+
+正規化前に作成したインデックスでは内積がコサイン類似度にならないため、一度だけ実行する。
+正規化済みのインデックスに実行しても結果は変わらない。
+
+    cd src
+    python -m api.migrate_normalize --index-dir index
+"""
+import argparse
+import glob
+import os
+
+import faiss
+import numpy as np
+
+from api import vector_store
+
+def migrate_index(path):
+    """インデックスのベクトルを正規化して同じ種類のインデックスとして書き直す"""
+    index = faiss.read_index(path)
+    vectors = vector_store.normalize_vectors(index.reconstruct_n(0, index.ntotal))
+    store_name = os.path.basename(path).rsplit("_", 1)[0]
+    params = vector_store.load_index_params(store_name, os.path.dirname(path))
+    new_index = vector_store.create_index(index.d, params)
+    vector_store.train_index(new_index, vectors)
+    new_index.add(vectors)
+    # 途中で中断しても元のインデックスが壊れないよう、一時ファイルに書き込んでから置き換える
+    vector_store.replace_file(path, lambda tmp_path: faiss.write_index(new_index, tmp_path))
+    norms = np.linalg.norm(vectors, axis=1)
+    return index.ntotal, float(norms.min()) if len(norms) else 0.0
+
+def main():
+    parser = argparse.ArgumentParser(description="既存の .index ファイルのベクトルを L2 正規化して書き直します。")
+    parser.add_argument("--index-dir", default="index", help="インデックスの保存先")
+    args = parser.parse_args()
+
+    for path in sorted(glob.glob(os.path.join(args.index_dir, "*.index"))):
+        ntotal, min_norm = migrate_index(path)
+        print(f"{path}: {ntotal} 件を正規化しました（最小ノルム {min_norm:.4f}）")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""依存関係（DAG）のある複数の処理を、依存先が終わったものから並行に実行する
+
+    lp = pipeline.Pipeline(max_workers=4)
+    lp.add("headings", generate_headings, inline=True)
+    lp.add("image_prompts", generate_image_prompts, deps=["headings"])
+    lp.add("html", generate_html, deps=["image_prompts"])
+    lp.add("image_1", generate_image_1, deps=["image_prompts"])
+    results = lp.run(on_done=render)
+    st.code(lp.waterfall())
+
+各ステージの関数は、依存先のステージの結果（ステージ名 -> 結果の dict）を受け取る。
+inline=True のステージは run を呼び出したスレッドで実行する（Streamlit の st.write_stream のように
+画面に出力する処理用）。それ以外はスレッドプールで実行するため、Streamlit の API は呼ばず、
+画面への表示は run を呼び出したスレッドで呼ばれる on_done で行う。
+依存先が失敗したステージは実行せず、SkippedError を on_done に渡す。
+"""
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+DEFAULT_MAX_WORKERS = 4
+
+class SkippedError(Exception):
+    """依存先のステージが失敗したため実行しなかった"""
+    def __init__(self, name, failed_deps):
+        super().__init__(f"{name} は依存先のステージ（{', '.join(failed_deps)}）が失敗したため実行しませんでした。")
+        self.failed_deps = failed_deps
+
+class Stage:
+    def __init__(self, name, func, deps=(), inline=False):
+        self.name = name
+        self.func = func
+        self.deps = tuple(deps)
+        self.inline = inline
+        self.start = None  # パイプライン開始からの経過時間[秒]
+        self.end = None
+
+    @property
+    def seconds(self):
+        return self.end - self.start if self.start is not None and self.end is not None else None
+
+class Pipeline:
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS):
+        self.max_workers = max_workers
+        self.stages = {}
+        self.results = {}
+        self.errors = {}
+        self.elapsed = None
+        self._start = None
+
+    def add(self, name, func, deps=(), inline=False):
+        """ステージを追加する。同時に実行できるステージは追加した順に開始する"""
+        if name in self.stages:
+            raise ValueError(f"ステージ {name} は追加済みです。")
+        self.stages[name] = Stage(name, func, deps, inline)
+        return self
+
+    def _validate(self):
+        """存在しない依存先と循環がないことを確認する"""
+        for stage in self.stages.values():
+            missing = [dep for dep in stage.deps if dep not in self.stages]
+            if missing:
+                raise ValueError(f"ステージ {stage.name} の依存先 {', '.join(missing)} がありません。")
+        visited, visiting = set(), set()
+
+        def visit(name):
+            if name in visited:
+                return
+            if name in visiting:
+                raise ValueError(f"ステージ {name} の依存関係が循環しています。")
+            visiting.add(name)
+            for dep in self.stages[name].deps:
+                visit(dep)
+            visiting.discard(name)
+            visited.add(name)
+
+        for name in self.stages:
+            visit(name)
+
+    def _now(self):
+        return time.perf_counter() - self._start
+
+    def _execute(self, stage):
+        stage.start = self._now()
+        try:
+            return stage.func({dep: self.results[dep] for dep in stage.deps})
+        finally:
+            stage.end = self._now()
+
+    def run(self, on_done=None):
+        """全ステージを実行し、成功したステージの結果（ステージ名 -> 結果）を返す
+
+        on_done(name, result, error) は各ステージの終了時に run を呼び出したスレッドで呼ばれる。
+        失敗したステージの例外は errors に残る。
+        """
+        self._validate()
+        self._start = time.perf_counter()
+        pending = list(self.stages)
+        running = {}
+
+        def finish(name, result=None, error=None):
+            if error is None:
+                self.results[name] = result
+            else:
+                self.errors[name] = error
+            if on_done:
+                on_done(name, result, error)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="pipeline") as executor:
+            while pending or running:
+                ready = [name for name in pending if all(dep in self.results or dep in self.errors for dep in self.stages[name].deps)]
+                inline = None
+                for name in ready:
+                    pending.remove(name)
+                    stage = self.stages[name]
+                    failed_deps = [dep for dep in stage.deps if dep in self.errors]
+                    if failed_deps:
+                        finish(name, error=SkippedError(name, failed_deps))
+                    elif stage.inline:
+                        if inline is None:
+                            inline = stage
+                        else:
+                            pending.append(name)
+                    else:
+                        running[executor.submit(self._execute, stage)] = name
+                if inline is not None:
+                    # バックグラウンドのステージを先に開始してから、呼び出し元のスレッドで実行する
+                    try:
+                        result = self._execute(inline)
+                    except Exception as e:
+                        finish(inline.name, error=e)
+                    else:
+                        finish(inline.name, result)
+                    continue
+                if ready:
+                    # 依存先の失敗で実行しなかったステージがあれば、後続のステージを先に判定する
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        finish(name, error=e)
+                    else:
+                        finish(name, result)
+        self.elapsed = time.perf_counter() - self._start
+        return self.results
+
+    def waterfall(self, width=40):
+        """各ステージの開始・終了時刻をテキストのウォーターフォール図にする"""
+        stages = [stage for stage in self.stages.values() if stage.start is not None]
+        if not stages:
+            return ""
+        total = max(self.elapsed or 0.0, max(stage.end for stage in stages)) or 1.0
+        label_width = max(len(stage.name) for stage in stages)
+        lines = []
+        for stage in sorted(stages, key=lambda stage: stage.start):
+            begin = min(int(stage.start / total * width), width - 1)
+            length = max(1, min(int(stage.end / total * width), width) - begin)
+            bar = " " * begin + "█" * length
+            status = " (失敗)" if stage.name in self.errors else ""
+            lines.append(f"{stage.name:<{label_width}} |{bar:<{width}}| {stage.start:6.1f}s - {stage.end:6.1f}s ({stage.seconds:.1f}s){status}")
+        lines.append(f"{'total':<{label_width}} |{'':<{width}}| {total:.1f}s")
+        return "\n".join(lines)
@@ -0,0 +1,130 @@
+"""複数ターンの会話のプロンプトキャッシュ
+
+LP の作成のように会話の履歴を毎回送り直す場合、ターンごとに入力トークンが増えていく。
+Bedrock のプロンプトキャッシュに対応したモデルでは、前のターンまでの履歴（変わらない先頭部分）に
+cache_control を付け、2 回目以降の読み込みをキャッシュから行う。
+対応していないモデルでも、同じリクエスト（temperature 0 で同じ会話）はプロセス内で応答を再利用する。
+
+    body = prompt_cache.build_body(messages, model_id, max_tokens=4096)
+    usage = {}
+    for text in prompt_cache.invoke_stream(client, body, model_id, usage):
+        ...
+    prompt_cache.format_usage(usage)
+"""
+import hashlib
+import json
+import os
+
+from api import common, image_store
+
+# Bedrock でプロンプトキャッシュに対応したモデル（クロスリージョン推論のプロファイル ID は前方一致で判定する）
+# 環境変数 BEDROCK_PROMPT_CACHE_MODELS（カンマ区切り）で追加できる
+PROMPT_CACHE_MODELS = (
+    "anthropic.claude-3-5-haiku-20241022-v1:0",
+    "anthropic.claude-3-7-sonnet-20250219-v1:0",
+    "anthropic.claude-sonnet-4-20250514-v1:0",
+    "anthropic.claude-opus-4-20250514-v1:0",
+)
+CACHE_CONTROL = {"type": "ephemeral"}
+DEFAULT_RESPONSE_CACHE_ITEMS = 128
+
+_responses = image_store.LRUCache(int(os.environ.get("LLM_RESPONSE_CACHE_ITEMS", DEFAULT_RESPONSE_CACHE_ITEMS)))
+
+def supports_prompt_cache(model_id):
+    """モデルが Bedrock のプロンプトキャッシュに対応しているか。BEDROCK_PROMPT_CACHE=off の場合は常に False"""
+    if os.environ.get("BEDROCK_PROMPT_CACHE", "on").lower() == "off":
+        return False
+    extra = [name.strip() for name in os.environ.get("BEDROCK_PROMPT_CACHE_MODELS", "").split(",") if name.strip()]
+    return any(model_id == name or model_id.endswith("." + name) for name in (*PROMPT_CACHE_MODELS, *extra))
+
+def mark_cache_point(messages):
+    """最後のユーザーの入力より前（前のターンまでの履歴）の末尾に cache_control を付けたコピーを返す
+
+    履歴がない（ユーザーの入力だけの）場合はそのまま返す。
+    """
+    if len(messages) < 2:
+        return messages
+    messages = [dict(message) for message in messages]
+    prefix = messages[-2]
+    content = prefix["content"]
+    if isinstance(content, str):
+        content = [{"type": "text", "text": content}]
+    content = [dict(block) for block in content]
+    content[-1]["cache_control"] = CACHE_CONTROL
+    prefix["content"] = content
+    return messages
+
+def build_body(messages, model_id, max_tokens, temperature=0.0):
+    """Claude へのリクエストボディ（JSON 文字列）。対応モデルでは会話の履歴をキャッシュする"""
+    if supports_prompt_cache(model_id):
+        messages = mark_cache_point(messages)
+    return json.dumps(
+    {
+        "anthropic_version": "bedrock-2023-05-31",
+        "max_tokens": max_tokens,
+        "temperature": temperature,
+        "messages": messages
+    })
+
+def _key(body, model_id):
+    return hashlib.blake2b(f"{model_id}\n{body}".encode("utf-8"), digest_size=16).digest()
+
+def _cached_usage(usage):
+    """プロセス内で再利用した応答の usage（Bedrock には送信していないため入力はすべてキャッシュ扱い）"""
+    return {
+        "input_tokens": 0,
+        "cache_read_input_tokens": 0,
+        "cache_creation_input_tokens": 0,
+        "output_tokens": usage.get("output_tokens", 0),
+        "local_cache_input_tokens": usage.get("input_tokens", 0) + usage.get("cache_read_input_tokens", 0) + usage.get("cache_creation_input_tokens", 0),
+    }
+
+def invoke(client, body, model_id, usage=None):
+    """Claude を呼び出して応答のテキストを返す。同じリクエストはプロセス内の応答を再利用する"""
+    key = _key(body, model_id)
+    cached = _responses.get(key)
+    if cached is not None:
+        text, cached_usage = cached
+        if usage is not None:
+            usage.update(_cached_usage(cached_usage))
+        return text
+    response = common.invoke_model(client, body, model_id)
+    response_body = json.loads(response.get("body").read())
+    text = response_body["content"][0]["text"]
+    response_usage = response_body.get("usage", {})
+    _responses.put(key, (text, response_usage))
+    if usage is not None:
+        usage.update(response_usage)
+    return text
+
+def invoke_stream(client, body, model_id, usage=None):
+    """Claude をストリーミングで呼び出し、テキストの差分を順に返す。同じリクエストはプロセス内の応答を再利用する
+
+    最後まで受信した応答のみ再利用する。
+    """
+    key = _key(body, model_id)
+    cached = _responses.get(key)
+    if cached is not None:
+        text, cached_usage = cached
+        if usage is not None:
+            usage.update(_cached_usage(cached_usage))
+        yield text
+        return
+    response_usage = {}
+    chunks = []
+    for text in common.invoke_model_stream(client, body, model_id, usage=response_usage):
+        chunks.append(text)
+        yield text
+    _responses.put(key, ("".join(chunks), response_usage))
+    if usage is not None:
+        usage.update(response_usage)
+
+def format_usage(usage):
+    """画面表示用の入力トークン数の内訳"""
+    return "入力トークン：キャッシュなし {} / キャッシュ読み込み {} / キャッシュ書き込み {} / 再利用 {}、出力トークン：{}".format(
+        usage.get("input_tokens", 0),
+        usage.get("cache_read_input_tokens", 0),
+        usage.get("cache_creation_input_tokens", 0),
+        usage.get("local_cache_input_tokens", 0),
+        usage.get("output_tokens", 0),
+    )
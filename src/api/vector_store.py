@@ -0,0 +1,265 @@
+"""FAISS インデックスと ID マップをプロセス内で共有して読み込む
+
+インデックスはファイルパスと更新時刻をキーにキャッシュし、全セッションで同じ読み取り専用の
+オブジェクトを参照する。ファイルが更新された場合は次回の読み込み時に再読み込みする。
+ID マップは FAISS の行番号順に image_name を並べた NumPy の文字列配列（.ids.npy）で、
+mmap して検索結果の行番号をまとめて引く。
+"""
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import faiss
+import numpy as np
+
+# インデックスの種類とデフォルトのパラメータ
+# - flat: 全件走査（正確だが件数に比例して遅くなる）
+# - hnsw: グラフベースの近似最近傍探索（efSearch で精度と速度を調整）
+# - ivf_flat / ivf_pq: クラスタリングによる近似最近傍探索（学習が必要、nprobe で精度と速度を調整）
+INDEX_TYPES = ("flat", "hnsw", "ivf_flat", "ivf_pq")
+DEFAULT_INDEX_PARAMS = {
+    "index_type": "flat",
+    "nlist": 1024,  # IVF のクラスタ数
+    "pq_m": 64,  # PQ のサブベクトル数（次元数を割り切れる値）
+    "hnsw_m": 32,  # HNSW の各ノードのリンク数
+    "nprobe": 16,  # IVF の検索時に探索するクラスタ数
+    "efSearch": 64,  # HNSW の検索時の探索幅
+}
+# ハイブリッド検索の融合方法
+# - rrf: 各インデックスでの順位から Reciprocal Rank Fusion でスコアを求める（類似度の尺度の違いに影響されない）
+# - weighted: 各インデックスのコサイン類似度の重み付き和（片方にしか現れない商品はもう片方を 0 とする）
+FUSION_METHODS = ("rrf", "weighted")
+RRF_K = 60  # RRF の順位に加える定数
+FUSION_CANDIDATES = 4  # 融合前に各インデックスから取得する件数（検索件数に対する倍率）
+
+MIN_POINTS_PER_CENTROID = 39  # faiss が推奨するクラスタあたりの学習データ数
+PQ_CENTROIDS = 256  # PQ (8bit) のコードブックサイズ
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+def normalize_vectors(vectors):
+    """ベクトルを float32 に変換して L2 正規化する
+
+    正規化済みのベクトル同士の内積はコサイン類似度になるため、インデックスへの登録時と
+    検索時の両方で適用する。
+    """
+    vectors = np.array(vectors, dtype=np.float32, ndmin=2)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+def index_paths(store_name, index_dir="index"):
+    """ストアのインデックスファイルのパスを取得する"""
+    return {
+        "txt_index": os.path.join(index_dir, store_name + "_txt.index"),
+        "img_index": os.path.join(index_dir, store_name + "_img.index"),
+        "txt_ids": os.path.join(index_dir, store_name + "_txt.ids.npy"),
+        "img_ids": os.path.join(index_dir, store_name + "_img.ids.npy"),
+    }
+
+def legacy_id_map_path(ids_path):
+    """旧形式（行番号をキーとする JSON）の ID マップのパス"""
+    return ids_path[:-len(".ids.npy")] + ".json"
+
+def to_id_array(id_map):
+    """{行番号: image_name} の辞書を行番号順の文字列配列に変換する"""
+    if isinstance(id_map, np.ndarray):
+        return id_map
+    names = [id_map[i] for i in range(len(id_map))]
+    return np.array(names, dtype=str) if names else np.array([], dtype="<U1")
+
+def resolve_ids(id_map, ids):
+    """検索結果の行番号（-1 を除く）をまとめて image_name に変換する"""
+    ids = np.asarray(ids)
+    return id_map[ids[ids != -1]]
+
+def replace_file(path, writer):
+    """一時ファイルに書き込んでから置き換える
+
+    mmap 中のファイルを直接上書きすると読み込み中のセッションが壊れるため、別のファイルとして
+    書き込み、rename で差し替える（既存の mmap は古いファイルを参照し続ける）。
+    """
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    writer(tmp_path)
+    os.replace(tmp_path, path)
+
+def save_id_map(path, id_map):
+    id_map = to_id_array(id_map)
+    def write(tmp_path):
+        with open(tmp_path, 'wb') as f:
+            np.save(f, id_map)
+    replace_file(path, write)
+
+def params_path(store_name, index_dir="index"):
+    """インデックスの種類と検索パラメータを保存するファイルのパス"""
+    return os.path.join(index_dir, store_name + "_params.json")
+
+def load_index_params(store_name, index_dir="index"):
+    params = dict(DEFAULT_INDEX_PARAMS)
+    path = params_path(store_name, index_dir)
+    if os.path.exists(path):
+        with open(path, 'r', encoding="utf-8") as f:
+            params.update(json.load(f))
+    return params
+
+def save_index_params(store_name, params, index_dir="index"):
+    os.makedirs(index_dir, exist_ok=True)
+    with open(params_path(store_name, index_dir), 'w', encoding="utf-8") as f:
+        json.dump(params, f, indent=2)
+
+def resolve_index_params(params, n):
+    """登録件数 n に対して学習可能なパラメータに調整する
+
+    IVF のクラスタ数は件数に合わせて減らし、学習データが足りない場合は flat に切り替える。
+    """
+    params = dict(DEFAULT_INDEX_PARAMS, **params)
+    if params["index_type"] in ("ivf_flat", "ivf_pq"):
+        params["nlist"] = max(1, min(params["nlist"], n // MIN_POINTS_PER_CENTROID))
+        # PQ はサブベクトルごとに PQ_CENTROIDS 個のコードブックを学習するため、より多くの学習データが必要
+        required = MIN_POINTS_PER_CENTROID * (params["nlist"] if params["index_type"] == "ivf_flat" else max(params["nlist"], PQ_CENTROIDS))
+        if n < required:
+            params["index_type"] = "flat"
+        params["nprobe"] = min(params["nprobe"], params["nlist"])
+    return params
+
+def index_factory_string(params):
+    index_type = params["index_type"]
+    if index_type == "flat":
+        return "Flat"
+    if index_type == "hnsw":
+        return f"HNSW{params['hnsw_m']},Flat"
+    if index_type == "ivf_flat":
+        return f"IVF{params['nlist']},Flat"
+    if index_type == "ivf_pq":
+        return f"IVF{params['nlist']},PQ{params['pq_m']}"
+    raise ValueError(f"サポートされていないインデックスの種類です: {index_type}")
+
+def create_index(dimension, params):
+    """パラメータに応じた内積のインデックスを作成する（正規化済みのベクトルではコサイン類似度）"""
+    index = faiss.index_factory(dimension, index_factory_string(params), faiss.METRIC_INNER_PRODUCT)
+    apply_search_params(index, params)
+    return index
+
+def train_index(index, vectors):
+    """学習が必要なインデックスを学習する。IVF は検索結果からベクトルを復元できるよう直接マップを作る"""
+    if not index.is_trained:
+        index.train(vectors)
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.make_direct_map()
+
+def apply_search_params(index, params):
+    """検索時のパラメータ（nprobe / efSearch）を設定する"""
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.nprobe = params["nprobe"]
+    if hasattr(index, "hnsw"):
+        index.hnsw.efSearch = params["efSearch"]
+
+def exists_store(store_name, index_dir="index"):
+    paths = index_paths(store_name, index_dir)
+    return all(os.path.exists(paths[key]) for key in ("txt_index", "img_index")) and all(
+        os.path.exists(paths[key]) or os.path.exists(legacy_id_map_path(paths[key])) for key in ("txt_ids", "img_ids")
+    )
+
+def _load_cached(path, loader):
+    mtime = os.path.getmtime(path)
+    with _cache_lock:
+        entry = _cache.get(path)
+        if entry is not None and entry[0] == mtime:
+            return entry[1]
+    obj = loader(path)
+    with _cache_lock:
+        _cache[path] = (mtime, obj)
+    return obj
+
+def _read_index(path):
+    # 読み取り専用で mmap し、プロセス内の全セッションで共有する
+    index = faiss.read_index(path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+    store_name = os.path.basename(path).rsplit("_", 1)[0]
+    apply_search_params(index, load_index_params(store_name, os.path.dirname(path)))
+    return index
+
+def _int_keys(obj):
+    return {int(k) if k.isdigit() else k: v for k, v in obj.items()}
+
+def read_legacy_id_map(path):
+    with open(path, 'r', encoding="utf-8") as f:
+        return json.load(f, object_hook=_int_keys)
+
+def _read_id_map(path):
+    if path.endswith(".json"):
+        return to_id_array(read_legacy_id_map(path))
+    return np.load(path, mmap_mode="r")
+
+def load_index(path):
+    return _load_cached(path, _read_index)
+
+def load_id_map(path):
+    """ID マップ（行番号順の image_name の配列）を取得する。.ids.npy が無ければ旧形式の JSON から変換する"""
+    if not os.path.exists(path):
+        path = legacy_id_map_path(path)
+    return _load_cached(path, _read_id_map)
+
+def load_store(store_name, index_dir="index"):
+    """ストアのインデックスと ID マップを取得する。戻り値は共有オブジェクトのため変更しないこと"""
+    paths = index_paths(store_name, index_dir)
+    return {
+        "vectorDB_text": load_index(paths["txt_index"]),
+        "vectorDB_img": load_index(paths["img_index"]),
+        "ref_idx_text": load_id_map(paths["txt_ids"]),
+        "ref_idx_img": load_id_map(paths["img_ids"]),
+    }
+
+def search_hits(index, id_map, vectors, k):
+    """検索結果を (image_name, 類似度, 行番号) のリストで返す。同じ商品は最上位のもののみ残す"""
+    ds, ids = index.search(vectors, min(k, index.ntotal))
+    valid = ids[0] != -1
+    names = resolve_ids(id_map, ids[0]).tolist()
+    hits, seen = [], set()
+    for image_name, d, i in zip(names, ds[0][valid].tolist(), ids[0][valid].tolist()):
+        if image_name in seen:
+            continue
+        seen.add(image_name)
+        hits.append((image_name, d, i))
+    return hits
+
+def fuse_hits(hit_lists, k, method="rrf", weights=None):
+    """インデックスごとの検索結果を image_name 単位で融合し、スコア順の 1 つのリストにする
+
+    hit_lists は {ラベル: search_hits の結果}。戻り値は image_name、score と、
+    ラベルごとの (類似度, 行番号) を持つ sources の辞書のリスト。
+    """
+    weights = weights or {}
+    fused = {}
+    for label, hits in hit_lists.items():
+        weight = weights.get(label, 1.0)
+        for rank, (image_name, similarity, row) in enumerate(hits):
+            entry = fused.setdefault(image_name, {"image_name": image_name, "score": 0.0, "sources": {}})
+            if method == "rrf":
+                entry["score"] += weight / (RRF_K + rank + 1)
+            elif method == "weighted":
+                entry["score"] += weight * similarity
+            else:
+                raise ValueError(f"サポートされていない融合方法です: {method}")
+            entry["sources"][label] = (similarity, row)
+    return sorted(fused.values(), key=lambda entry: entry["score"], reverse=True)[:k]
+
+def hybrid_search(targets, vectors, k, method="rrf", weights=None):
+    """複数のインデックスを並列に検索し、融合した結果を返す
+
+    targets は {ラベル: (インデックス, ID マップ)}。FAISS の検索は GIL を解放するため、
+    スレッドで並列に実行できる。
+    """
+    depth = k * FUSION_CANDIDATES
+    with ThreadPoolExecutor(max_workers=len(targets)) as executor:
+        futures = {
+            label: executor.submit(search_hits, index, id_map, vectors, depth)
+            for label, (index, id_map) in targets.items()
+        }
+        hit_lists = {label: future.result() for label, future in futures.items()}
+    return fuse_hits(hit_lists, k, method, weights)
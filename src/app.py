@@ -1,10 +1,14 @@
 import logging
 import streamlit as st
 from st_pages import get_nav_from_toml
+from api import env
 
 # ログの設定
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# 環境変数は起動時に 1 回だけ読み込む（各ページの依存モジュールは、そのページを開いたときに読み込まれる）
+env.load_env_if_exists()
+
 nav = get_nav_from_toml(".streamlit/pages_sections.toml")
 pg = st.navigation(nav)
 pg.run()
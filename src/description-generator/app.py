@@ -1,25 +1,16 @@
 import os
-import base64
 import json
-from dotenv import load_dotenv
 import streamlit as st
-from langchain.prompts import (
-    ChatPromptTemplate, 
-    MessagesPlaceholder, 
-)
-from langchain_community.chat_models import BedrockChat
-from langchain.memory import ConversationBufferMemory
-from langchain.schema import (
-    messages_from_dict, 
-    messages_to_dict,
-    HumanMessage,
-)
-
-import time
+from PIL import Image
+from api import common, lazy
+
 import io
 
-# Load environment variables
-load_dotenv()
+# 会話履歴の保存（save_memory / load_memory）にのみ langchain を使うため、利用するまで読み込まない
+memory_module = lazy.module("langchain.memory")
+schema = lazy.module("langchain.schema")
+
+MAX_TOKENS = 1024  # BedrockChat（langchain）を利用していたときのデフォルト値
 
 # Function to load prompt from S3 bucket
 def load_prompt():
@@ -31,7 +22,7 @@ def load_prompt():
 def save_memory(memory, session_id):
     file_path = f'./{session_id}.json'
     with open(file_path, 'w', encoding='utf-8') as file:
-        file.write(json.dumps(messages_to_dict(memory.chat_memory.messages)))
+        file.write(json.dumps(schema.messages_to_dict(memory.chat_memory.messages)))
 
 # Function to load conversation memory from local file system
 def load_memory(session_id):
@@ -39,56 +30,46 @@ def load_memory(session_id):
     try:
         with open(file_path, 'r', encoding='utf-8') as file:
             json_data = json.load(file)
-            memory = ConversationBufferMemory(return_messages=False, human_prefix="H", assistant_prefix="A")
-            memory.chat_memory.messages = messages_from_dict(json_data)
+            memory = memory_module.ConversationBufferMemory(return_messages=False, human_prefix="H", assistant_prefix="A")
+            memory.chat_memory.messages = schema.messages_from_dict(json_data)
     except FileNotFoundError:
-        memory = ConversationBufferMemory(return_messages=False, human_prefix="H", assistant_prefix="A")
+        memory = memory_module.ConversationBufferMemory(return_messages=False, human_prefix="H", assistant_prefix="A")
     return memory
 
-# Function to handle chat with model
-def chat(message, session_id, model_id):
-    start = time.perf_counter()
+# Function to handle chat with model (streaming)
+def chat_stream(message, session_id, model_id):
     system_prompt = load_prompt()
     # memory = load_memory(session_id)
     # messages = memory.chat_memory.messages
-    messages = {"human_input":message}
-
-    prompt = ChatPromptTemplate.from_messages([
-        ("system", system_prompt),
-        # MessagesPlaceholder(variable_name="history"),
-        MessagesPlaceholder(variable_name="human_input")
-    ])
-    
-    LLM = BedrockChat(
-        # model_id="anthropic.claude-3-sonnet-20240229-v1:0",
-        model_id=model_id,
-        region_name=os.environ['region']
-    )
 
-    chain = prompt | LLM
-
-    human_input = [HumanMessage(content=message)]
-    resp = chain.invoke(
-        {
-            # "history": messages,
-            "human_input": human_input,
-        }
-    )
-
-    response = resp.content
+    # 他のページと同じく api.common 経由で呼び出し、モデルごとのレート制限とスロットリング時のリトライを共有する
+    body = {
+        "anthropic_version": "bedrock-2023-05-31",
+        "max_tokens": MAX_TOKENS,
+        "system": system_prompt,
+        "messages": [{"role": "user", "content": message}],
+    }
+    yield from common.invoke_model_stream(common.get_client("bedrock-runtime"), body, model_id)
 
     # if isinstance(message, str):
     #     memory.chat_memory.messages.append(human_input[0])
     # else:
     #     text = next(item for item in message if item['type'] == 'text')['text']
-    #     memory.chat_memory.messages.append(HumanMessage(content=text))
+    #     memory.chat_memory.messages.append(schema.HumanMessage(content=text))
         
     # memory.chat_memory.messages.append(AIMessage(content=response))
     # save_memory(memory, session_id)
-    end = time.perf_counter()
-    duration = end - start
 
-    return response, duration
+# Function to stream the response on screen and return it with timings
+def chat(message, session_id, model_id):
+    timer = common.StreamTimer()
+    placeholder = st.empty()
+    with placeholder.container():
+        response = st.write_stream(timer.wrap(chat_stream(message, session_id, model_id)))
+    # 生成完了後は結果欄に表示するため、ストリーミング表示は消す
+    placeholder.empty()
+
+    return response, timer.summary()
 
 def load_default_image(default_image_path="./store_source/store/02.png"):
     """デフォルト画像を読み込む関数"""
@@ -204,18 +185,16 @@ value=f"""
     if st.button("商品説明文の生成"):
         with st.spinner('処理中...'):
             if uploaded_file is not None:
-                # To read file as bytes:
-                bytes_data = uploaded_file.getvalue()
-                encoded_string = base64.b64encode(bytes_data).decode("utf-8")
+                image = Image.open(io.BytesIO(uploaded_file.getvalue()))
 
                 response, duration = chat([
-                    {"type": "image_url", "image_url": { "url": "data:image/jpeg;base64,"+encoded_string } },
+                    common.ImageProcessor.image_content(image),
                     {
                         "type": "text",
                         "text": prompt_analyze
                     },
                 ], session_id, model_id)
-                st.session_state.messages_1.append({'title': "商品説明文の生成結果", 'duration': "処理時間：{:.2f}秒".format(duration), 'message': response, 'count': len(st.session_state.messages_1)+1})
+                st.session_state.messages_1.append({'title': "商品説明文の生成結果", 'duration': duration, 'message': response, 'count': len(st.session_state.messages_1)+1})
         
     
     # for dict in st.session_state.messages_1:
@@ -250,7 +229,7 @@ XMLタグは出力しないでください。
                 "text": prompt_desc_gen
             }
         ], session_id, model_id)
-        st.session_state.messages_2.append({'title': "商品説明文、カテゴリ、インスタグラム案", 'duration': "処理時間：{:.2f}秒".format(duration), 'message': response, 'count': len(st.session_state.messages_2)+1})
+        st.session_state.messages_2.append({'title': "商品説明文、カテゴリ、インスタグラム案", 'duration': duration, 'message': response, 'count': len(st.session_state.messages_2)+1})
 
     if len(st.session_state.messages_2) > 0:
         dict = st.session_state.messages_2[-1]
@@ -316,7 +295,7 @@ DIY・工具・ガーデン
                 "text": prompt_desc_gen
             }
         ], session_id, model_id)
-        st.session_state.messages_3.append({'title': "カテゴリ結果", 'duration': "処理時間：{:.2f}秒".format(duration), 'message': response, 'count': len(st.session_state.messages_3)+1})
+        st.session_state.messages_3.append({'title': "カテゴリ結果", 'duration': duration, 'message': response, 'count': len(st.session_state.messages_3)+1})
 
     if len(st.session_state.messages_3) > 0:
         dict = st.session_state.messages_3[-1]
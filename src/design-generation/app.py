@@ -1,93 +1,31 @@
 import base64
-import boto3
 import io
-import json
 import os
 from PIL import Image
 import logging
-from rembg import remove
-from dotenv import load_dotenv
 import streamlit as st
+from api import common, image_workers, inpainting
 
 # ログの設定
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# dotenv で環境変数を読み込む
-def load_env_if_exists():
-    """カレントディレクトリの .env ファイルから環境変数を読み込む。"""
-    if os.path.exists('.env'):
-        load_dotenv('.env')
-
-load_env_if_exists()
-
-THRESHOLD = 128 # 2 値化の閾値
-
-def create_binary_mask(masked_image):
-    """マスク画像を2値化する"""
-    mask = masked_image.point(lambda x: 0 if x > THRESHOLD else 255)
-    return mask
-
-def remove_background(input_image):
-    """背景を削除する"""
-    # rembgを使用して背景を削除
-    # only_mask=True でマスク画像のみを出力
-    output_image = remove(input_image,only_mask=True, alpha_matting=True)
-
-    return output_image
-
-def convert_image_to_base64(image_input):
-    """画像をBase64エンコードされた文字列に変換"""
-    if isinstance(image_input, str):
-        if not os.path.isfile(image_input):
-            raise FileNotFoundError(f"指定されたファイルが見つかりません: {image_input}")
-        with open(image_input, "rb") as file:
-            return base64.b64encode(file.read()).decode("utf-8")
-    elif isinstance(image_input, Image.Image):
-        buffer = io.BytesIO()
-        image_input.save(buffer, format="PNG")
-        return base64.b64encode(buffer.getvalue()).decode("utf-8")
-    else:
-        raise ValueError("サポートされていない型です。str (ファイルパス) または PIL.Image.Image が必要です。")
-
 def get_image_bytes(image, format="PNG"):
     """画像をバイト形式で取得する"""
     buffer = io.BytesIO()
     image.save(buffer, format=format)
     return buffer.getvalue()
 
-class TranslationError(Exception):
-    """Translateでエラーが発生した場合のカスタム例外クラス"""
-    def __init__(self, message="Translateでエラーが発生しました。", errors=None):
-        super().__init__(message)
-        self.errors = errors
-
-class Translator:
-    def __init__(self, region_name='ap-northeast-1'):
-        self.client = boto3.client(service_name="translate", region_name=region_name)
-
-    def translate_text(self, text, source_language_code='ja', target_language_code='en'):
-        """テキストを翻訳する"""
-        try:
-            result = self.client.translate_text(Text=text, SourceLanguageCode=source_language_code, TargetLanguageCode=target_language_code)
-            return result.get('TranslatedText')
-        except Exception as e:
-            logging.error(f"翻訳中にエラーが発生しました: {e}")
-            raise TranslationError(errors=e)
-
 class BedrockAPI:
     def __init__(self):
-        self.client = boto3.client(service_name="bedrock-runtime", region_name=os.environ['region'])
+        self.client = common.get_client("bedrock-runtime")
 
     def invoke_model(self, body, modelId):
         """Bedrockのモデルを呼び出す"""
-        response = self.client.invoke_model(body=json.dumps(body), modelId=modelId, accept="application/json", contentType="application/json")
-        response_body = json.loads(response.get("body").read())
-        images = [Image.open(io.BytesIO(base64.b64decode(base64_image))) for base64_image in response_body.get("images")]
-        return images
+        return inpainting.invoke_edit_image(self.client, modelId, body)
 
     def edit_image(self, task_type, prompt, negative_prompt, image, maskImage=None, num_images=1, seed=0):
         """画像編集タスクを実行する"""
-        translator = Translator()
+        translator = inpainting.Translator()
         translated_prompt = translator.translate_text(prompt)
         logging.info("Amazon Bedrock で画像生成を実行します。")
         logging.info(f"プロンプト（英訳前）: {prompt}")
@@ -95,23 +33,8 @@ class BedrockAPI:
         logging.info(f"ネガティブプロンプト: {negative_prompt}")
         logging.info(f"シード値: {seed}")
 
-        body = {
-            "taskType": task_type.upper(),
-            "inPaintingParams": {
-                "text": translated_prompt,
-                "negativeText": negative_prompt,
-                "image": convert_image_to_base64(image),
-            },
-            "imageGenerationConfig": {
-                "numberOfImages": num_images,
-                "quality": "standard",
-                "cfgScale": 8.0,
-                "seed": seed,
-            }
-        }
-        if maskImage:
-            body["inPaintingParams"]["maskImage"] = convert_image_to_base64(maskImage)
-        return self.invoke_model(body, modelId="amazon.titan-image-generator-v1")
+        body = inpainting.build_edit_image_body(inpainting.TITAN_IMAGE_MODEL_ID, task_type, translated_prompt, negative_prompt, image, maskImage, num_images, seed)
+        return self.invoke_model(body, modelId=inpainting.TITAN_IMAGE_MODEL_ID)
 
 import random  # ランダムモジュールをインポート
 
@@ -152,13 +75,10 @@ def upload_image(default_image):
     return default_image
 
 def resize_image(image, max_dimension=MAX_IMAGE_DIMENSION):
-    """画像のサイズを調整する関数"""
-    if image.width > max_dimension or image.height > max_dimension:
-        if image.width > image.height:
-            return image.resize((max_dimension, int(image.height * max_dimension / image.width)))
-        else:
-            return image.resize((int(image.width * max_dimension / image.height), max_dimension))
-    return image
+    """画像のサイズを調整する関数（縮小はワーカープロセスで実行する）"""
+    if image is None:
+        return None
+    return image_workers.resize_to_fit(image, max_dimension)
 
 def get_prompts():
     """プロンプトとネガティブプロンプトの入力を受け取る関数"""
@@ -169,9 +89,9 @@ def get_prompts():
 def generate_images(image, prompt, negative_prompt, seed_value, num_images):
     """画像生成処理を実行する関数"""
     with st.spinner('画像を生成中です...'):
-        bg_removed_image = remove_background(image)
+        mask, bg_removed_image, duration_mask = inpainting.create_mask(image, invert=True)
         if bg_removed_image:
-            mask = create_binary_mask(bg_removed_image)
+            st.text("マスク処理時間：{:.2f}秒".format(duration_mask))
             bedrock_api = BedrockAPI()
             generated_images = bedrock_api.edit_image("INPAINTING", prompt, negative_prompt, image, maskImage=mask, num_images=num_images, seed=seed_value)
             return generated_images, bg_removed_image
@@ -217,6 +137,8 @@ def main():
     − Inpaint を利用することで、マスク部分以外の画像生成を行います
 ---
 """)
+    # 背景削除のモデルは、このページを開いた時点からバックグラウンドで読み込んでおく
+    image_workers.warm_up_in_background()
     initialize_session_state()
     default_image = load_default_image()
     image = upload_image(default_image)
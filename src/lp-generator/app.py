@@ -1,41 +1,31 @@
 import base64
-import boto3
 import io
 import json
 from PIL import Image
 import logging
-from dotenv import load_dotenv
 import streamlit as st
+from api import common, lp_assets, pipeline, prompt_cache
 import streamlit.components.v1 as components
-import asyncio
-import os
-import glob
-import shutil
+import time
 import uuid
 
 
 # ログの設定
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# dotenv で環境変数を読み込む
-def load_env_if_exists():
-    """カレントディレクトリの .env ファイルから環境変数を読み込む。"""
-    load_dotenv('.env')
-
-load_env_if_exists()
-
 class BedrockAPI:
     def __init__(self):
-        self.client = boto3.client(service_name="bedrock-runtime", region_name=os.environ['region'])
+        self.client = common.get_client("bedrock-runtime")
 
-    def invoke_model(self, body, modelId):
-        """Bedrockのモデルを呼び出す"""
-        response = self.client.invoke_model(body=body, modelId=modelId, accept="application/json", contentType="application/json")
-        response_body = json.loads(response.get("body").read())
-        return response_body["content"][0]["text"]
-    async def image_invoke_model(self, body, modelId):
+    def invoke_model(self, body, modelId, usage=None):
+        """Bedrockのモデルを呼び出す（同じリクエストは応答を再利用する）"""
+        return prompt_cache.invoke(self.client, body, modelId, usage)
+    def invoke_model_stream(self, body, modelId, usage=None):
+        """Bedrockのモデルをストリーミングで呼び出し、テキストの差分を順に返す（同じリクエストは応答を再利用する）"""
+        return prompt_cache.invoke_stream(self.client, body, modelId, usage)
+    def image_invoke_model(self, body, modelId):
         """Bedrock の image モデルを呼び出す"""
-        response = self.client.invoke_model(body=body, modelId=modelId, accept="application/json", contentType="application/json")
+        response = common.invoke_model(self.client, body, modelId)
         response_body = json.loads(response.get("body").read())
         images = [Image.open(io.BytesIO(base64.b64decode(base64_image))) for base64_image in response_body.get("images")]
         return images
@@ -49,52 +39,121 @@ bedrock_api = BedrockAPI()
 MODEL_ID = "anthropic.claude-3-haiku-20240307-v1:0"
 # sonnetId = "anthropic.claude-3-sonnet-20240229-v1:0"
 sonnetId = "anthropic.claude-3-5-sonnet-20240620-v1:0"
+IMAGE_MODEL_ID = "amazon.titan-image-generator-v1"
+# 画像を並列に生成する数（レート制限は api.common でモデルごとに全セッション共有）
+MAX_CONCURRENT_IMAGES = 4
 
-async def titan_image_generator(image_dict: dict,seed):
-    for file in glob.glob("static/*"):
-        os.remove(file)
-    for dict_key, prompt in list(image_dict.items()):
-        body = json.dumps(
-            {
-                "taskType": "TEXT_IMAGE",
-                "textToImageParams": {
-                    "text": f"{prompt[:511]}",   # Required
-                },
-                "imageGenerationConfig": {
-                    "numberOfImages": 1,   # Range: 1 to 5 
-                    "quality": "premium",  # Options: standard or premium
-                    "height": 768,         # Supported height list in the docs 
-                    "width": 1280,         # Supported width list in the docs
-                    "cfgScale": 7.5,       # Range: 1.0 (exclusive) to 10.0
-                    "seed": seed           # Range: 0 to 214783647
-                }
+def build_image_body(prompt, seed):
+    """Titan Image Generator で LP 用の画像を 1 枚生成するリクエストボディ"""
+    return json.dumps(
+        {
+            "taskType": "TEXT_IMAGE",
+            "textToImageParams": {
+                "text": f"{prompt[:511]}",   # Required
+            },
+            "imageGenerationConfig": {
+                "numberOfImages": 1,   # Range: 1 to 5 
+                "quality": "premium",  # Options: standard or premium
+                "height": 768,         # Supported height list in the docs 
+                "width": 1280,         # Supported width list in the docs
+                "cfgScale": 7.5,       # Range: 1.0 (exclusive) to 10.0
+                "seed": seed           # Range: 0 to 214783647
             }
-        )
-        try:
-
-            response = await bedrock_api.image_invoke_model(
-                body=body, 
-                modelId="amazon.titan-image-generator-v1"
-            )
-            for _, img in enumerate(response):
-                img.save(f"static/{dict_key}.png")
-                # bytes_data = img.getvalue()
-                # image = Image.open(io.BytesIO(bytes_data))
-
-                # # アップロードされた画像を MAX_IMAGE_DIMENSION x MAX_IMAGE_DIMENSION 以下にする
-                # if image.width > MAX_IMAGE_DIMENSION or image.height > MAX_IMAGE_DIMENSION:
-                #     # 画像の縦横比を維持したまま、長辺を MAX_IMAGE_DIMENSION にする
-                #     if image.width > image.height:
-                #         image = image.resize((MAX_IMAGE_DIMENSION, int(image.height * MAX_IMAGE_DIMENSION / image.width)))
-                #     else:
-                #         image = image.resize((int(image.width * MAX_IMAGE_DIMENSION / image.height), MAX_IMAGE_DIMENSION))
-
-                st.image(img, caption=f"生成された画像 {dict_key}")
-        except Exception as e:
-            print("error", e.response['Error']['Code'])
-            st.error(f"エラーが発生しました、LPからこの画像を除きます: {e}")
-            image_dict.pop(dict_key)
+        }
+    )
+
+def generate_image(prompt, seed, assets):
+    """画像を 1 枚生成してセッションのディレクトリに保存し、(画像, ファイル名, PNG のバイト列, 処理時間) を返す
+
+    ワーカースレッドで実行するため Streamlit の API は呼ばない。
+    """
+    start = time.perf_counter()
+    images = bedrock_api.image_invoke_model(body=build_image_body(prompt, seed), modelId=IMAGE_MODEL_ID)
+    img = images[0]
+    filename, data = assets.save_image(img)
+    return img, filename, data, time.perf_counter() - start
+
+def build_message_body(messages, model_id):
+    """Claude へのリクエストボディ（プロンプトキャッシュに対応したモデルでは、前のターンまでの履歴をキャッシュする）"""
+    return prompt_cache.build_body(messages, model_id, MAX_OUTPUT_TOKENS)
 
+def stream_turn(messages, usage):
+    """会話の 1 ターン分の回答をストリーミングで表示し、回答文を返す（画面に出力するため呼び出し元のスレッドで実行する）"""
+    timer = common.StreamTimer()
+    text = st.write_stream(timer.wrap(bedrock_api.invoke_model_stream(build_message_body(messages, MODEL_ID), modelId=MODEL_ID, usage=usage)))
+    st.caption(timer.summary())
+    st.caption(prompt_cache.format_usage(usage))
+    return text
+
+def generate_image_prompts(content, img_name_dict, usage=None):
+    """各セクションの画像の説明（画像名 -> 英語のプロンプト）を作成する"""
+    image_num = len(img_name_dict)
+    prompt = build_message_body([
+        {
+            "role": "user",
+            "content": f"""
+<content></content>を元に、各セクションに画像の説明をする文章を<rule></rule>に従って英語で作成してください。
+出力は<output></output>のJSON形式で出力してください。画像名は<name></name>で与えられたモノを順に利用してください。
+JSON 以外は出力しないでください。
+<content>{content}</content>
+<rule>
+- HTMLのタグで表現できる内容は画像にしないでください。
+- 画像の説明は{image_num}枚分作成してください。
+- 暴力的な表現や誇大広告は避けてください。
+- 生成する文章は AWS の責任ある AI ポリシーに従ってください。ポリシーのurl はhttps://aws.amazon.com/jp/machine-learning/responsible-ai/policy/ です。
+</rule>
+<name>
+{img_name_dict}
+</name>
+<output>
+{{
+    'image_9e3d82f':'ここに画像の説明をする文章を英語で入力します。画像生成 AI のプロンプトに沿った形式で入力してください。'
+}}
+</output>
+    """
+        }
+    ], sonnetId)
+    image_dict = bedrock_api.invoke_model(prompt,modelId=sonnetId,usage=usage)
+    image_dict = image_dict.strip('<output>')
+    image_dict = image_dict.rstrip('</output>')
+    return dict(json.loads(image_dict))
+
+def generate_html(content, image_dict, reference_image=None, usage=None):
+    """LP の HTML を作成する。画像はファイル名と説明だけを渡すため、画像の生成と並行して実行できる"""
+    # 画像を生成しない場合の プロンプト
+    image_contain_prompt = " - 画像のタグは生成しないでください。"
+    if image_dict:
+        image_contain_prompt = f'''- 画像のタグは<img src="./app/static/image_7e0ceb1.png"> のように作成してください。
+- <images></images>の画像から選択し、同じ画像は使わないようにしてください。
+- 画像のタグは {len(image_dict)} つ作成してください。'''
+    # 画像を参考にしてデザインを作成する場合のプロンプト (参考にしない場合)
+    add_image_prompt = ""
+    if reference_image is not None:
+        # 画像を参考にしてデザインを作成する場合のプロンプト (参考にする場合)
+        add_image_prompt = "デザインは添付の画像を参考にして作成してください。"
+    # HTML を作成するためのプロンプト
+    prompt = f"""
+<content></content>を元に、LP を作成してください。
+{add_image_prompt}
+作成には<rule></rule>に従ってください。HTML と Style のみを出力してください。それ以外は出力しないでください。
+<rule>
+- 出力はHTMLと、それを修飾するためのStyleのみを出力してください。
+{image_contain_prompt}
+</rule>
+<images>
+{image_dict}
+</images>
+<content>{content}</content>
+                        """
+    if reference_image is not None:
+        # 画像をプロンプトの先頭に配置する
+        messages = [{"role": "user","content":[reference_image, {"type": "text", "text": prompt}]}]
+    else:
+        messages = [{"role": "user","content": prompt}]
+    html = bedrock_api.invoke_model(build_message_body(messages, sonnetId),modelId=sonnetId,usage=usage)
+    html = html.strip('```html')
+    html = html.rstrip('```')
+    return html
 
 def generate_random_hash(length=10):
     return "image_"+str(uuid.uuid4())[:length]
@@ -105,6 +164,9 @@ def main():
     # セッションステートでシード値を管理
     if 'seed_value' not in st.session_state:
         st.session_state.seed_value = 0  # 初期値を設定
+    # 生成した画像・HTML はセッションごとのディレクトリ（static/<セッション ID>/）に保存する
+    if 'lp_session_id' not in st.session_state:
+        st.session_state.lp_session_id = lp_assets.new_session_id()
     # セッションステートで生成する画像数を管理
     if 'image_num' not in st.session_state:
         st.session_state.image_num = 3  # 初期値を設定
@@ -126,7 +188,6 @@ def main():
                 image = image.resize((int(image.width * MAX_IMAGE_DIMENSION / image.height), MAX_IMAGE_DIMENSION))
 
         st.image(image, caption="アップロードされた画像")
-        image_base64 = base64.b64encode(bytes_data).decode("utf-8")
     image_num = st.number_input("LP 内で使用する画像数を入力してください (0 から 20)", min_value=0, max_value=20, value=st.session_state.image_num, step=1)
     if image_num != 0:
         seed_value = st.number_input("シード値を入力してください (0 から " + str(MAX_SEED_VALUE) + ")", min_value=0, max_value=MAX_SEED_VALUE, value=st.session_state.seed_value, step=1)
@@ -152,217 +213,149 @@ def main():
 
     # 処理を開始するボタン
     if st.button("HTMLを生成する"):
-        # 処理中はローディング状態を表示
-        with st.spinner('HTMLを生成中です...'):
-            # Amazon Bedrock でHTML生成を実行する
-            # prompt の入力
-            prompt = json.dumps(
-            {
-                "anthropic_version": "bedrock-2023-05-31",
-                "max_tokens": MAX_OUTPUT_TOKENS,
-                "temperature": 0.0,
-                "messages": [
-                    {
-                        "role": "user",
-                        "content": user_prompt_1
-                    }
-                ]
-            })
-
-            # 1回目の LLM からの回答文
-            assistant_return_1 = bedrock_api.invoke_model(prompt,modelId=MODEL_ID)
+        # 2回目・3回目のユーザの入力文
+        user_prompt_2 = "LPのセクションの内容を作成するにあたって、追加で必要となる情報を質問してください。"
+        user_prompt_3 = "実際に各セクションに、見出しと本文にダミー情報を入れてください。"
+        # 画像名をランダム生成
+        img_name_dict = [generate_random_hash() for _ in range(image_num)]
+        # 期限切れのセッションの生成物を削除してから、このセッションの保存先を用意する
+        lp_assets.collect_garbage()
+        assets = lp_assets.SessionAssets(st.session_state.lp_session_id)
+        build_id = lp_assets.new_build_id()
+        st.session_state.pop("lp_build", None)
+        # Claude を呼び出すステージごとの入力トークン数（キャッシュの内訳）
+        usages = {name: {} for name in ("headings", "questions", "content", "image_prompts", "html")}
+
+        # 見出し -> 質問 -> ダミー情報 の会話は画面に順に表示する。
+        # HTML は画像のファイル名と説明だけを使うため、画像の生成と並行して作成する。
+        def headings(results):
             st.subheader("LP の見出しリスト")
-            st.markdown(assistant_return_1)
-        with st.spinner('HTMLを生成中です...'):
-            # 2回目のユーザの入力文
-            user_prompt_2 = "LPのセクションの内容を作成するにあたって、追加で必要となる情報を質問してください。"
-            prompt = json.dumps(
-            {
-                "anthropic_version": "bedrock-2023-05-31",
-                "max_tokens": MAX_OUTPUT_TOKENS,
-                "temperature": 0.0,
-                "messages": [
-                    {
-                        "role": "user",
-                        "content": user_prompt_1
-                    },
-                    {
-                        "role": "assistant",
-                        "content": assistant_return_1
-                    },
-                    {
-                        "role": "user",
-                        "content": user_prompt_2
-                    }
-                ]
-            })
-            # 2回目の LLM からの回答文
-            assistant_return_2 = bedrock_api.invoke_model(prompt,modelId=MODEL_ID)
-            # 3回目のユーザの入力文
+            return stream_turn([
+                {"role": "user", "content": user_prompt_1},
+            ], usages["headings"])
+
+        def questions(results):
             st.subheader("見出しリストへの肉付け")
-            st.markdown(assistant_return_2)
-        with st.spinner('HTMLを生成中です...'):
-            user_prompt_3 = "実際に各セクションに、見出しと本文にダミー情報を入れてください。"
-            prompt = json.dumps(
-            {
-                "anthropic_version": "bedrock-2023-05-31",
-                "max_tokens": MAX_OUTPUT_TOKENS,
-                "temperature": 0.0,
-                "messages": [
-                    {
-                        "role": "user",
-                        "content": user_prompt_1
-                    },
-                    {
-                        "role": "assistant",
-                        "content": assistant_return_1
-                    },
-                    {
-                        "role": "user",
-                        "content": user_prompt_2
-                    },
-                    {
-                        "role": "assistant",
-                        "content": assistant_return_2
-                    },
-                    {
-                        "role": "user",
-                        "content": user_prompt_3
-                    }
-
-                ]
-            })
-            # 3回目の LLM からの返却文
-            assistant_return_3 = bedrock_api.invoke_model(prompt,modelId=MODEL_ID)
+            return stream_turn([
+                {"role": "user", "content": user_prompt_1},
+                {"role": "assistant", "content": results["headings"]},
+                {"role": "user", "content": user_prompt_2},
+            ], usages["questions"])
+
+        def dummy_content(results):
             st.subheader("サンプルとしてダミーの情報を入れる")
-            st.markdown(assistant_return_3)
-        with st.spinner('HTMLを生成中です...'):
+            return stream_turn([
+                {"role": "user", "content": user_prompt_1},
+                {"role": "assistant", "content": results["headings"]},
+                {"role": "user", "content": user_prompt_2},
+                {"role": "assistant", "content": results["questions"]},
+                {"role": "user", "content": user_prompt_3},
+            ], usages["content"])
 
-            # 画像を生成しない場合の プロンプト
-            image_contain_prompt = " - 画像のタグは生成しないでください。"
-            if image_num != 0:
-                # 画像名をランダム生成
-                img_name_dict=[]
-                for i in range(image_num):
-                    img_name_dict.append(generate_random_hash())
-                print(img_name_dict)
-
-                # 画像を生成するためのプロンプト
-                prompt = json.dumps(
-                {
-                    "anthropic_version": "bedrock-2023-05-31",
-                    "max_tokens": MAX_OUTPUT_TOKENS,
-                    "temperature": 0.0,
-                    "messages": [
-                        {
-                            "role": "user",
-                            "content": f"""
-<content></content>を元に、各セクションに画像の説明をする文章を<rule></rule>に従って英語で作成してください。
-出力は<output></output>のJSON形式で出力してください。画像名は<name></name>で与えられたモノを順に利用してください。
-JSON 以外は出力しないでください。
-<content>{assistant_return_3}</content>
-<rule>
-- HTMLのタグで表現できる内容は画像にしないでください。
-- 画像の説明は{image_num}枚分作成してください。
-- 暴力的な表現や誇大広告は避けてください。
-- 生成する文章は AWS の責任ある AI ポリシーに従ってください。ポリシーのurl はhttps://aws.amazon.com/jp/machine-learning/responsible-ai/policy/ です。
-</rule>
-<name>
-{img_name_dict}
-</name>
-<output>
-{{
-    'image_9e3d82f':'ここに画像の説明をする文章を英語で入力します。画像生成 AI のプロンプトに沿った形式で入力してください。'
-}}
-</output>
-    """
-                            }
-                        ]
-                    })
-                # 画像生成のための dict 生成
-                image_dict = bedrock_api.invoke_model(prompt,modelId=sonnetId)
-                image_dict = image_dict.strip('<output>')
-                image_dict = image_dict.rstrip('</output>')
-                image_dict = dict(json.loads(image_dict))
-                print(image_dict)
-            for i,v in enumerate(image_dict.values()):
-                st.subheader(f"生成する画像の説明: {i+1}")
-                st.markdown(v)
+        # 画像の生成と HTML の生成を同時に実行するため、画像の並列数 + 1
+        lp = pipeline.Pipeline(max_workers=MAX_CONCURRENT_IMAGES + 1)
+        lp.add("headings", headings, inline=True)
+        lp.add("questions", questions, deps=["headings"], inline=True)
+        lp.add("content", dummy_content, deps=["headings", "questions"], inline=True)
+        html_deps = ["content"]
+        if uploaded_file is not None:
+            # 参考画像のエンコードは会話と並行して行う
+            lp.add("reference_image", lambda results: common.ImageProcessor.image_content(image))
+            html_deps.append("reference_image")
+        if image_num != 0:
+            lp.add("image_prompts", lambda results: generate_image_prompts(results["content"], img_name_dict, usages["image_prompts"]), deps=["content"])
+            html_deps.append("image_prompts")
+        # 画像より先に開始させるため、画像のステージより先に追加する
+        lp.add("html", lambda results: generate_html(results["content"], results.get("image_prompts", {}), results.get("reference_image"), usages["html"]), deps=html_deps)
+        for dict_key in img_name_dict:
+            lp.add(dict_key, lambda results, dict_key=dict_key: generate_image(results["image_prompts"][dict_key], seed_value, assets), deps=["image_prompts"])
+
+        image_placeholders = {}
+
+        def on_done(name, result, error):
+            """ステージの終了時に結果を表示する（呼び出し元のスレッドで呼ばれる）"""
+            if name in img_name_dict:
+                placeholder = image_placeholders.get(name)
+                if placeholder is None:
+                    return
+                if error is not None:
+                    logging.error(f"画像 {name} の生成に失敗しました: {error}")
+                    placeholder.error(f"エラーが発生しました、LPからこの画像を除きます: {error}")
+                else:
+                    img = result[0]
+                    placeholder.image(img, caption=f"生成された画像 {name}")
+                return
+            if error is not None:
+                logging.error(f"{name} の生成に失敗しました: {error}")
+                st.error(f"エラーが発生しました ({name}): {error}")
+                return
+            if name == "image_prompts":
+                for i,v in enumerate(result.values()):
+                    st.subheader(f"生成する画像の説明: {i+1}")
+                    st.markdown(v)
+                # 表示順を保つため、先に画像ごとのプレースホルダーを用意しておく
+                for dict_key in img_name_dict:
+                    image_placeholders[dict_key] = st.empty()
+                    image_placeholders[dict_key].caption(f"画像 {dict_key} を生成中です...")
+
+        # 処理中はローディング状態を表示
         with st.spinner('HTMLを生成中です...'):
-            if image_num != 0:
-                asyncio.run(titan_image_generator(image_dict,seed_value))
-                # 生成した画像を
-                image_contain_prompt = f'''- 画像のタグは<img src="./app/static/image_7e0ceb1.png"> のように作成してください。
-- <images></images>の画像から選択し、同じ画像は使わないようにしてください。
-- 画像のタグは {len(image_dict)} つ作成してください。'''
-            content = []
-            # 画像を参考にしてデザインを作成する場合のプロンプト (参考にしない場合)
-            add_image_prompt = ""
-            if uploaded_file is not None:
-                # 画像をプロンプトの先頭に配置する
-                content.append(
-                    {
-                    "type": "image",
-                    "source": {
-                        "type": "base64",
-                        "media_type": uploaded_file.type,
-                        "data": image_base64,
-                    },
-                })
-                # 画像を参考にしてデザインを作成する場合のプロンプト (参考にする場合)
-                add_image_prompt = "デザインは添付の画像を参考にして作成してください。"
-            # HTML を作成するためのプロンプト
-            prompt = f"""
-<content></content>を元に、LP を作成してください。
-{add_image_prompt}
-作成には<rule></rule>に従ってください。HTML と Style のみを出力してください。それ以外は出力しないでください。
-<rule>
-- 出力はHTMLと、それを修飾するためのStyleのみを出力してください。
-{image_contain_prompt}
-</rule>
-<images>
-{image_dict}
-</images>
-<content>{assistant_return_3}</content>
-                        """
-            content.append(
-                    {
-                        "type": "text",
-                        "text": prompt
-                    }
-            )    
-            prompt = json.dumps(
-            {
-                "anthropic_version": "bedrock-2023-05-31",
-                "max_tokens": MAX_OUTPUT_TOKENS,
-                "temperature": 0.0,
-                "messages": [{"role": "user","content":content}] if uploaded_file is not None else [{
-                    "role": "user",
-                    "content": prompt
-                }]
-            })
-            # 生成した HTML
-
-            html = bedrock_api.invoke_model(prompt,modelId=sonnetId)
-            html = html.strip('```html')
-            html = html.rstrip('```')
-            with open("static/bedrock_lp_generator.html","w", encoding="utf-8") as f:
-                f.write(html)
-            shutil.make_archive('static', format='zip', root_dir='static')
-            st.subheader("作成した LP")
-            with st.container(border=True):
-                # HTML の出力
-                components.html(html,height=1000,scrolling=True)
-                with open("static.zip", "rb") as file:
-                    st.download_button(
-                        label="HTMLをダウンロード",
-                        data=file,
-                        # file_name=f"bedrock_lp_generator.html",
-                        file_name="static.zip",
-                        # mime="text/html"
-                        mime="application/zip"
-                    )
+            results = lp.run(on_done=on_done)
+        with st.expander(f"処理時間 {lp.elapsed:.1f}秒"):
+            st.code(lp.waterfall())
+            st.table([
+                {
+                    "ステージ": name,
+                    "入力（キャッシュなし）": usage.get("input_tokens", 0),
+                    "キャッシュ読み込み": usage.get("cache_read_input_tokens", 0),
+                    "キャッシュ書き込み": usage.get("cache_creation_input_tokens", 0),
+                    "再利用": usage.get("local_cache_input_tokens", 0),
+                    "出力": usage.get("output_tokens", 0),
+                }
+                for name, usage in usages.items() if usage
+            ])
+        if "html" not in results:
+            return
+        # 画像名 -> 保存したファイル名（生成に失敗した画像の img タグは HTML から除く）
+        image_files = {name: results[name][1] for name in img_name_dict if name in results}
+        html = lp_assets.rewrite_image_sources(results["html"], {name: assets.url(filename) for name, filename in image_files.items()})
+        assets.save_html(build_id, html)
+        # ダウンロード用の HTML は ZIP 内の画像を相対パスで参照する
+        download_html = lp_assets.rewrite_image_sources(results["html"], image_files).encode("utf-8")
+        # ZIP は生成直後の画像のバイト列から作成し、ビルドごとにキャッシュする
+        lp_assets.get_archive(build_id, lambda: [("bedrock_lp_generator.html", download_html)] + list({results[name][1]: results[name][2] for name in image_files}.items()))
+        st.session_state.lp_build = {
+            "build_id": build_id,
+            "html": html,
+            "download_html": download_html,
+            "image_files": list(image_files.values()),
+        }
+
+    # 作成した LP はダウンロードボタンを押した後の再実行でも表示する
+    build = st.session_state.get("lp_build")
+    if build is not None:
+        assets = lp_assets.SessionAssets(st.session_state.lp_session_id)
+        st.subheader("作成した LP")
+        with st.container(border=True):
+            # HTML の出力
+            components.html(build["html"],height=1000,scrolling=True)
+            try:
+                # キャッシュから削除されている場合は、保存済みの画像から作り直す
+                archive = lp_assets.get_archive(
+                    build["build_id"],
+                    lambda: [("bedrock_lp_generator.html", build["download_html"])] + [(filename, assets.path(filename)) for filename in dict.fromkeys(build["image_files"])],
+                )
+            except FileNotFoundError:
+                st.warning("保存期間を過ぎたため、ダウンロード用のファイルを作成できません。LP を作成し直してください。")
+            else:
+                st.download_button(
+                    label="HTMLをダウンロード",
+                    data=archive,
+                    # file_name=f"bedrock_lp_generator.html",
+                    file_name="static.zip",
+                    # mime="text/html"
+                    mime="application/zip"
+                )
      
 # if __name__ == "__main__":
 main()
-
@@ -1,44 +1,12 @@
-import numpy as np
 import os
 import streamlit as st
-import pandas as pd
 import glob
-import faiss
-from api import common
-from PIL import Image
-import json
+from api import catalog, embedding_cache, image_store, indexer, vector_store
 
 def exists_dir(save_dir):
     if not os.path.exists(save_dir):
         os.makedirs(save_dir)
 
-def load_images(dir_path):
-    files = os.listdir(dir_path)
-    ret = []
-    for file in [f for f in files if f.endswith(".jpg") or f.endswith(".png") or f.endswith(".bmp")]:
-        file_path = os.path.join(dir_path, file)
-        ret.append(Image.open(file_path))
-    return ret
-
-def load_item_list_files(dir_path):
-    files = os.listdir(dir_path)
-    ret = []
-    for file in [f for f in files if f.endswith(".csv") or f.endswith(".txt")]:
-        file_path = os.path.join(dir_path, file)
-        ret.append(read_item_list_csv(file_path))
-    return ret
-    
-def read_item_list_csv(file_path):
-    return pd.read_csv(
-        file_path,
-        names = ['image_name','item_name','item_desc'],
-        header = 0,
-        sep = ',',
-        skipinitialspace = True,
-        quotechar = '"',
-        quoting = 0
-    )
-
 def delete_files_in_directory(directory):
     try:
         # ディレクトリ内のすべてのファイルのパスを取得
@@ -51,40 +19,21 @@ def delete_files_in_directory(directory):
     except Exception as e:
         print(f"Error deleting files: {e}")
         
-def add_text_vectorDB(vectorDB, ref, text, name):
-    bedrock_api = common.BedrockAPI()
-    vector = bedrock_api.get_vector_titan_multi_modal(
-        None, 
-        text
-    )
-    vectorDB.add(np.array([vector]))
-    ref[vectorDB.ntotal-1] = name
-
-def add_image_vectorDB(vectorDB, ref, image, name):
-    bedrock_api = common.BedrockAPI()
-    vector = bedrock_api.get_vector_titan_multi_modal(
-        image, 
-        None,
-    )
-    vectorDB.add(np.array([vector]))
-    ref[vectorDB.ntotal-1] = name
-    
-def add_item_list(df_item_list):
-    st.session_state["pdframe_item_list"] = pd.concat(
-        [st.session_state["pdframe_item_list"], 
-        df_item_list]
-    )
+def set_item_list(item_list):
+    """商品リストのカタログ（image_name で商品名・商品説明文を引ける）をセッションから参照する"""
+    st.session_state["item_catalog"] = item_list
 
     
 def init_vectorDB():
-    # IndexFlatIP : コサイン類似度
-    st.session_state["vectorDB_img"] = faiss.IndexFlatIP(1024)
-    st.session_state["vectorDB_text"] = faiss.IndexFlatIP(1024)
-    st.session_state["ref_idx_img"] = {}
-    st.session_state["ref_idx_text"] = {}
+    st.session_state["shared_store_name"] = None
+    st.session_state["vectorDB_img"] = indexer.init_index()
+    st.session_state["vectorDB_text"] = indexer.init_index()
+    st.session_state["ref_idx_img"] = vector_store.to_id_array({})
+    st.session_state["ref_idx_text"] = vector_store.to_id_array({})
+    st.session_state["index_params"] = dict(vector_store.DEFAULT_INDEX_PARAMS)
     
 def init_item_list():
-    st.session_state["pdframe_item_list"] = pd.DataFrame()
+    st.session_state["item_catalog"] = catalog.Catalog()
     
 def need_initialize():
     return "vectorDB_img" not in st.session_state or "vectorDB_text" not in st.session_state
@@ -104,8 +53,11 @@ def display_items(images, display_size = 5):
             if row_idx == 2:
                 st.write("")
 
-def int_keys(obj):
-    return {int(k) if k.isdigit() else k: v for k, v in obj.items()}
+def use_shared_store(store_name):
+    """共有キャッシュのインデックスと ID マップをセッションから参照する"""
+    st.session_state.update(vector_store.load_store(store_name))
+    st.session_state["index_params"] = vector_store.load_index_params(store_name)
+    st.session_state["shared_store_name"] = store_name
 
 def main():
     st.title("商品登録")
@@ -189,42 +141,31 @@ def main():
     #                         st.write(data.item_desc)
     #         st.success("登録に成功しました。")
 
-    txt_index_name = "index/" + st.session_state["store_name"] + "_txt.index"
-    img_index_name = "index/" + st.session_state["store_name"] + "_img.index"
-    ref_idx_txt_json = "index/" + st.session_state["store_name"] + "_txt.json"
-    ref_idx_img_json = "index/" + st.session_state["store_name"] + "_img.json"
+    paths = vector_store.index_paths(st.session_state["store_name"])
+    txt_index_name = paths["txt_index"]
+    img_index_name = paths["img_index"]
+    # 旧形式（JSON）の ID マップのみの場合はそちらを表示する
+    ref_idx_txt_ids, ref_idx_img_ids = (
+        path if os.path.exists(path) else vector_store.legacy_id_map_path(path)
+        for path in (paths["txt_ids"], paths["img_ids"])
+    )
 
     
-    if os.path.exists(txt_index_name) and os.path.exists(img_index_name):
+    if vector_store.exists_store(st.session_state["store_name"]):
         st.info(
             f"""
             インデックスパス：{txt_index_name} サイズ：{os.path.getsize(txt_index_name)} byte  
             インデックスパス：{img_index_name} サイズ：{os.path.getsize(img_index_name)} byte  
-            jsonパス：{ref_idx_txt_json} サイズ：{os.path.getsize(ref_idx_txt_json)} byte  
-            jsonパス：{ref_idx_img_json} サイズ：{os.path.getsize(ref_idx_img_json)} byte""")
+            ID マップパス：{ref_idx_txt_ids} サイズ：{os.path.getsize(ref_idx_txt_ids)} byte  
+            ID マップパス：{ref_idx_img_ids} サイズ：{os.path.getsize(ref_idx_img_ids)} byte""")
         if st.button("商品インデックスのロード"):
-            # Index Load
-            st.session_state["vectorDB_text"] = faiss.read_index(txt_index_name)
-            st.session_state["vectorDB_img"] = faiss.read_index(img_index_name)
+            # Index / Dict Load（全セッションで共有するキャッシュから参照する）
+            use_shared_store(st.session_state["store_name"])
             # 画面表示
             st.text(f"vectorDB_text: {st.session_state['vectorDB_text'].ntotal}")
             st.text(f"vectorDB_img: {st.session_state['vectorDB_img'].ntotal}")
-            # Dict Load
-            with open(ref_idx_txt_json, 'r', encoding="utf-8") as f:
-                print("text json load")
-                print(ref_idx_txt_json)
-                st.session_state["ref_idx_text"] = json.load(f, object_hook=int_keys)
-                print (st.session_state["ref_idx_text"])
-            with open(ref_idx_img_json, 'r', encoding="utf-8") as f:
-                print("img json load")
-                print(ref_idx_img_json)
-                st.session_state["ref_idx_img"] = json.load(f, object_hook=int_keys)
-                print (st.session_state["ref_idx_img"]) 
-            for item_list in load_item_list_files(save_dir):
-                st.text(item_list)
-                init_item_list()
-                add_item_list(item_list)
-                st.text(st.session_state["pdframe_item_list"])
+            set_item_list(catalog.load_catalog(save_dir))
+            st.text(f"item_catalog: {len(st.session_state['item_catalog'])}")
     else:
         st.warning("インデックスが存在しません。初期化操作を行ってください。")
 
@@ -235,41 +176,51 @@ def main():
         st.markdown("""
 - 初期化 - 商品データ登録 : 商品データの画像とテキストをベクトル化し、FAISSに登録します
 - 商品インデックスの保存 : 一度 FAISS に登録したデータを `.index` ファイルとしてローカル保存します
+- インデックスの種類 : 商品数が多い場合は近似最近傍探索（HNSW / IVF）を選ぶと検索が高速になります。件数が少なく学習できない場合は Flat で登録します
                     """)
+        index_params = dict(vector_store.DEFAULT_INDEX_PARAMS)
+        index_params["index_type"] = st.selectbox("インデックスの種類", vector_store.INDEX_TYPES)
+        if index_params["index_type"] == "hnsw":
+            index_params["efSearch"] = st.number_input("efSearch（検索時の探索幅）", min_value=1, value=index_params["efSearch"])
+        elif index_params["index_type"] in ("ivf_flat", "ivf_pq"):
+            index_params["nlist"] = st.number_input("nlist（クラスタ数）", min_value=1, value=index_params["nlist"])
+            index_params["nprobe"] = st.number_input("nprobe（検索時に探索するクラスタ数）", min_value=1, value=index_params["nprobe"])
         if st.button("初期化 - 商品データ登録"):
             with st.spinner('Titan Multimodal Embeddings G1で商品データの画像とテキストをベクトル化し、FAISSに登録中です...'):
-                init_vectorDB()
-                for image in load_images(save_dir):
-                    add_image_vectorDB(
-                        st.session_state["vectorDB_img"], 
-                        st.session_state["ref_idx_img"],
-                        image, 
-                        os.path.basename(image.filename)
-                    )
-                init_item_list()
-                for item_list in load_item_list_files(save_dir):
-                    add_item_list(item_list)
-                    for data in item_list.itertuples():
-                        st.write(data.image_name)
-                        add_text_vectorDB(
-                            st.session_state["vectorDB_text"], 
-                            st.session_state["ref_idx_text"],
-                            data.item_desc,
-                            data.image_name
-                        )
+                progress_bar = st.progress(0.0)
+                labels = {"image": "商品画像", "thumbnail": "サムネイル", "text": "商品説明文"}
+                index_img, ref_img, index_txt, ref_txt, item_list, params = indexer.build_store_index(
+                    save_dir,
+                    progress=lambda label, done, total: progress_bar.progress(
+                        done / total, text=f"{labels[label]}: {done}/{total}"
+                    ),
+                    index_params=index_params,
+                )
+                st.session_state["index_params"] = params
+                st.session_state["vectorDB_img"] = index_img
+                st.session_state["ref_idx_img"] = ref_img
+                st.session_state["vectorDB_text"] = index_txt
+                st.session_state["ref_idx_text"] = ref_txt
+                set_item_list(item_list)
             
-            st.success("商品データ登録に成功しました。")
+            st.success(f"商品データ登録に成功しました。（インデックス: {st.session_state['index_params']['index_type']}）")
+            cache = embedding_cache.get_default_cache()
+            if cache is not None:
+                stats = cache.stats()
+                st.caption(
+                    f"埋め込みキャッシュ: ヒット {stats['memory_hits'] + stats['disk_hits']} 件 / "
+                    f"ミス {stats['misses']} 件（ミス分のみ Bedrock を呼び出しました）"
+                )
 
         if st.button("商品インデックスの保存"):
-            # Indexの保存
-            exists_dir("index/")
-            faiss.write_index(st.session_state["vectorDB_text"],txt_index_name)
-            faiss.write_index(st.session_state["vectorDB_img"],img_index_name)
-            # Dictの保存
-            with open(ref_idx_txt_json, 'w', encoding="utf-8") as f:
-                json.dump(st.session_state["ref_idx_text"], f)
-            with open(ref_idx_img_json, 'w', encoding="utf-8") as f:
-                json.dump(st.session_state["ref_idx_img"], f)
+            indexer.save_store_index(
+                st.session_state["store_name"],
+                st.session_state["vectorDB_text"],
+                st.session_state["ref_idx_text"],
+                st.session_state["vectorDB_img"],
+                st.session_state["ref_idx_img"],
+                params=st.session_state.get("index_params"),
+            )
             st.success("インデックスの保存に成功しました。")
             
 
@@ -278,13 +229,14 @@ def main():
         ## 登録結果
     """)
 
-    if "ref_idx_img" in st.session_state and "pdframe_item_list" in st.session_state:
-        image_names = st.session_state["ref_idx_img"].values()
+    if "ref_idx_img" in st.session_state and "item_catalog" in st.session_state:
+        image_names = st.session_state["ref_idx_img"].tolist()
         st.write(f"画像登録数: {len(image_names)}")
         try:
-            display_items([Image.open(os.path.join(save_dir, image_name)) for image_name in image_names])
-            item_list = st.session_state["pdframe_item_list"]
-            st.write(item_list)
+            # 表示はキャッシュ済みのサムネイルを使い、再実行のたびに元画像をデコードしない
+            display_items([image_store.get_thumbnail(os.path.join(save_dir, image_name)) for image_name in image_names])
+            item_list = st.session_state["item_catalog"]
+            st.dataframe(item_list.to_records())
             st.write(st.session_state["ref_idx_img"])
             st.write(st.session_state["ref_idx_text"])
         except FileNotFoundError:
@@ -3,66 +3,97 @@ import numpy as np
 import os
 from PIL import Image
 import streamlit as st
-from api import common
-from numpy import dot
-from numpy.linalg import norm
-import time
+from api import common, image_store, vector_store
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-class RateLimiter:
-    def __init__(self, calls_per_second):
-        self.calls_per_second = calls_per_second
-        self.last_call = 0
+bedrock_api = common.BedrockAPI()
 
-    def wait(self):
-        now = time.time()
-        time_since_last_call = now - self.last_call
-        if time_since_last_call < 1 / self.calls_per_second:
-            time.sleep((1 / self.calls_per_second) - time_since_last_call)
-        self.last_call = time.time()
+# 商品説明・比較文を並列に生成する数（レート制限は api.common でモデルごとに全セッション共有）
+MAX_CONCURRENT_GENERATIONS = 8
 
-rate_limiter = RateLimiter(2)  # 1秒あたり2回のリクエストを許可
+def render_when_completed(futures):
+    """生成が完了したものから順に、対応するプレースホルダーへ表示する"""
+    for future in as_completed(futures):
+        placeholder = futures[future]
+        try:
+            placeholder.write(future.result())
+        except Exception as e:
+            placeholder.error(f"生成に失敗しました: {e}")
 
+# 検索モード：検索対象のインデックスのラベル（ハイブリッドは両方を検索して融合する）
+SEARCH_MODES = {
+    "テキスト": ("text",),
+    "画像": ("img",),
+    "ハイブリッド": ("text", "img"),
+}
+FUSION_METHOD_LABELS = {"rrf": "順位による融合 (RRF)", "weighted": "類似度の重み付き和"}
 
+def reconstruct_vectors(vectorDB, ids):
+    """検索結果の行番号から、インデックスに登録済みのベクトルを復元する"""
+    return vectorDB.reconstruct_batch(np.asarray(ids, dtype=np.int64))
 
-def calc_similarity(left_text, left_image, right_text, right_image):
-    left_vector = get_vector(left_text, left_image)
-    right_vector = get_vector(right_text, right_image)
-    # コサイン類似度を求める計算式
-    return dot(left_vector, right_vector) / (norm(left_vector) * norm(right_vector)) 
-
-def get_vector(text, image):
-    if text is None and image is None:
-        return []
-
-    bedrock_api = common.BedrockAPI()
-    vector = bedrock_api.get_vector_titan_multi_modal(
-        image if image is not None else None, 
-        text if text is not None else None,
-    )
-    
-    return vector
+def calc_similarities(first_vector, vectors):
+    """先頭の商品と各商品のコサイン類似度をまとめて求める（登録済みのベクトルは正規化済みのため内積）"""
+    return vectors @ first_vector
 
 def signle_compare_panel(side):
     text = st.text_input("商品説明を入力", key=side + "text_input")
     
     return text
     
-def search(k, vectorDB, text, image):
-    bedrock_api = common.BedrockAPI()
+def search(k, labels, text, image, method="rrf", weights=None):
+    """クエリを 1 回だけベクトル化し、指定したインデックスを検索して 1 つのランキングにする"""
     vector = bedrock_api.get_vector_titan_multi_modal(
         image, 
         text
     )
-    return vectorDB.search(np.array([vector]), k)
-    
+    targets = {
+        "text": (st.session_state["vectorDB_text"], st.session_state["ref_idx_text"]),
+        "img": (st.session_state["vectorDB_img"], st.session_state["ref_idx_img"]),
+    }
+    return vector_store.hybrid_search(
+        {label: targets[label] for label in labels},
+        vector_store.normalize_vectors(vector),
+        k,
+        method if len(labels) > 1 else "weighted",
+        weights,
+    )
+
+def comparison_rows(hits, label):
+    """比較に使うインデックスでの各商品の行番号を取得する（検索結果に無い場合は ID マップから逆引き）
+
+    テキストと画像のインデックスは別々に作成するため、一方にしか登録されていない商品は None になる。
+    """
+    rows = [hit["sources"].get(label, (None, None))[1] for hit in hits]
+    if None in rows:
+        id_map = st.session_state["ref_idx_text" if label == "text" else "ref_idx_img"]
+        name_to_row = {name: row for row, name in enumerate(id_map.tolist())}
+        rows = [row if row is not None else name_to_row.get(hit["image_name"]) for row, hit in zip(rows, hits)]
+    return rows
+
+def comparison_similarities(vectorDB, rows):
+    """先頭の商品と 2 件目以降の各商品の類似度。行番号が無い商品（インデックス未登録）は None"""
+    if not rows or rows[0] is None:
+        return [None] * max(0, len(rows) - 1)
+    valid = [i for i, row in enumerate(rows) if row is not None]
+    vectors = reconstruct_vectors(vectorDB, [rows[i] for i in valid])
+    similarities = dict(zip(valid, calc_similarities(vectors[0], vectors)))
+    return [similarities.get(i) for i in range(1, len(rows))]
+
+def format_score(hit, labels):
+    if len(labels) == 1:
+        return f"類似度: {hit['score']:.2f}"
+    sources = " / ".join(
+        f"{'テキスト' if label == 'text' else '画像'} {hit['sources'][label][0]:.2f}"
+        for label in labels if label in hit["sources"]
+    )
+    return f"スコア: {hit['score']:.3f}（{sources}）"
+
 def get_item_desc(image_name):
-    df = st.session_state["pdframe_item_list"]
-    return df[df["image_name"] == image_name][:1]["item_desc"].values[0]
+    return st.session_state["item_catalog"].item_desc(image_name)
 
 def get_item_name(image_name):
-    df = st.session_state["pdframe_item_list"]
-    # print(df[df["image_name"]==image_name][:1]["item_name"].values[0])
-    return df[df["image_name"] == image_name][:1]["item_name"].values[0]
+    return st.session_state["item_catalog"].item_name(image_name)
 
 def main():
     st.session_state["left_item_idx"] = 0
@@ -77,7 +108,7 @@ def main():
         st.session_state["store_name"] = 'store'
         st.error('ストア名が登録されていません')
     try:
-        if len(st.session_state["ref_idx_img"].values()) == 0:
+        if len(st.session_state["ref_idx_img"]) == 0:
             st.error('商品が登録されていません')
     except KeyError:
         pass
@@ -99,158 +130,167 @@ def main():
         image = Image.open(io.BytesIO(bytes_data))
         st.image(image, caption="アップロードされた画像")
         
-    on_text = st.toggle(label="テキストモードON (ON:商品説明文に対してクエリー、off: 商品画像に対してクエリー)", value=True)
+    mode = st.radio(
+        "検索モード (テキスト: 商品説明文に対してクエリー、画像: 商品画像に対してクエリー、ハイブリッド: 両方を検索して 1 つのランキングに融合)",
+        list(SEARCH_MODES),
+        horizontal=True,
+    )
+    labels = SEARCH_MODES[mode]
+    fusion_method = "rrf"
+    weights = None
+    if len(labels) > 1:
+        fusion_method = st.selectbox("融合方法", vector_store.FUSION_METHODS, format_func=FUSION_METHOD_LABELS.get)
+        text_weight = st.slider("テキストの重み（画像の重みは 1 - テキストの重み）", 0.0, 1.0, 0.5, 0.1)
+        weights = {"text": text_weight, "img": 1.0 - text_weight}
 
     # 処理を開始するボタン
     num_results = st.number_input("検索件数を指定してください", min_value=1, max_value=10, value=3)
     if st.button("検索する"):
         st.session_state["search_results"] = None
+        # 共有インデックスを参照している場合、ファイルが更新されていれば再読み込みされたものに差し替える
+        shared_store_name = st.session_state.get("shared_store_name")
+        if shared_store_name and vector_store.exists_store(shared_store_name):
+            st.session_state.update(vector_store.load_store(shared_store_name))
         if "vectorDB_img" not in st.session_state or st.session_state["vectorDB_img"].ntotal == 0:
             st.info("商品登録がありません。")
         elif "vectorDB_text" not in st.session_state or st.session_state["vectorDB_text"].ntotal == 0:
             st.info("商品登録がありません。")
         else:
-            if on_text:
-                st.session_state["search_results"] = search(
-                    num_results,
-                    st.session_state["vectorDB_text"], 
-                    text, 
-                    image if "image" in locals() else None
-                )
-            else:
-                st.session_state["search_results"] = search(
-                    num_results,
-                    st.session_state["vectorDB_img"], 
-                    text, 
-                    image if "image" in locals() else None
-                )
-            st.markdown("""
+            st.session_state["search_results"] = search(
+                num_results,
+                labels,
+                text, 
+                image if "image" in locals() else None,
+                method=fusion_method,
+                weights=weights,
+            )
+            # 商品説明・比較文の生成は並列に実行し、完了したものから表示する
+            executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_GENERATIONS)
+            try:
+                futures = {}
+                st.markdown("""
             ----
             #### 商品検索結果
             """)
-            if "search_results" in st.session_state and st.session_state["search_results"]:
-                ds, ids = st.session_state["search_results"]
+                if "search_results" in st.session_state and st.session_state["search_results"]:
+                    hits = st.session_state["search_results"]
                         
-                display_size = 3
-                rows = st.columns(display_size)
-                item_list = []
+                    display_size = 3
+                    rows = st.columns(display_size)
+                    item_list = []
                 
-                item_desc_system_prompt = "あなたは商品を説明するプロです。お客様の性別、年齢、趣味に合う商品の良さを説明してください。"
+                    item_desc_system_prompt = "あなたは商品を説明するプロです。お客様の性別、年齢、趣味に合う商品の良さを説明してください。"
                 
-                if "user_info" in  st.session_state:
-                    for attr in st.session_state["user_info"]:
-                        value = st.session_state["user_info"][attr]
-                        item_desc_system_prompt = item_desc_system_prompt + f"お客様の {attr} は {value} です。"
-                if text:
-                    item_desc_system_prompt = item_desc_system_prompt + f"お客様からは「{text}」とのご要望をいただいています。回答時にご要望に対する補足説明を含めてください。 "
+                    if "user_info" in  st.session_state:
+                        for attr in st.session_state["user_info"]:
+                            value = st.session_state["user_info"][attr]
+                            item_desc_system_prompt = item_desc_system_prompt + f"お客様の {attr} は {value} です。"
+                    if text:
+                        item_desc_system_prompt = item_desc_system_prompt + f"お客様からは「{text}」とのご要望をいただいています。回答時にご要望に対する補足説明を含めてください。 "
         
             
-                for i, idx in enumerate(ids[0]):
-                    idx = int(idx)
-                    if idx != -1:
-                        image_name = None
-                        if on_text:
-                            image_name = st.session_state["ref_idx_text"][idx]
-                        else:
-                            image_name = st.session_state["ref_idx_img"][idx]
+                    for i, hit in enumerate(hits):
+                        image_name = hit["image_name"]
                         item_list.append(image_name)
                         file_path = os.path.join(save_dir, image_name)
-                        image = Image.open(file_path)
-                        similarity = ds[0][i]
+                        image = image_store.get_image(file_path)
                         row_idx = i // display_size
                         col_idx = i % display_size
-            
+        
                         with rows[col_idx]:
                             with st.container(height=600):
-                                st.image(image, caption=image_name, width=80)
-                                st.write(f"類似度: {similarity:.2f}")
-                                rate_limiter.wait()
-                                bedrock_api = common.BedrockAPI()
+                                st.image(image_store.get_thumbnail(file_path), caption=image_name, width=80)
+                                st.write(format_score(hit, labels))
                                 #st.write(image_name)
 
                                 #get_item_name(image_name)
                                 st.write(get_item_name(image_name))
 
-
-                                generated_desc = bedrock_api.get_item_desc_message(
+                                placeholder = st.empty()
+                                placeholder.caption("商品説明を生成中です...")
+                                future = executor.submit(
+                                    bedrock_api.get_item_desc_message,
                                     image, 
                                     get_item_desc(image_name), 
                                     system_prompt = item_desc_system_prompt,
                                     modelId = "anthropic.claude-3-haiku-20240307-v1:0"
                                 )
-                                st.write(generated_desc)
-    
+                                futures[future] = placeholder
+
                                 # 最後の行の場合は空白を追加
                                 if row_idx == 2:
                                     st.write("")
-                st.session_state["search_result_name_list"] = item_list
+                    st.session_state["search_result_name_list"] = item_list
             
-            st.markdown("""
+                st.markdown("""
             ----
             #### 商品比較結果
             """)
         
-            if "search_results" in st.session_state and st.session_state["search_results"]:
-                ds, ids = st.session_state["search_results"]
-                item_compare_system_prompt = """
+                if "search_results" in st.session_state and st.session_state["search_results"]:
+                    hits = st.session_state["search_results"]
+                    item_compare_system_prompt = """
 あなたは商品を推薦する目利きの担当者です。
 2 つの商品が提示されるので、共通点と相違点をまとめてください。
 日本語で回答してください。
 商品画像や商品説明文と異なるメッセージはしないでください。
 """
-                if "user_info" in  st.session_state:
-                    for attr in st.session_state["user_info"]:
-                        value = st.session_state["user_info"][attr]
-                        item_compare_system_prompt = item_compare_system_prompt + f"お客様の {attr} は {value} です。"
-                if text:
-                    item_compare_system_prompt = item_compare_system_prompt + f"お客様からは「{text}」とのご要望をいただいています。回答時にご要望に対する補足説明を含めてください。 "
+                    if "user_info" in  st.session_state:
+                        for attr in st.session_state["user_info"]:
+                            value = st.session_state["user_info"][attr]
+                            item_compare_system_prompt = item_compare_system_prompt + f"お客様の {attr} は {value} です。"
+                    if text:
+                        item_compare_system_prompt = item_compare_system_prompt + f"お客様からは「{text}」とのご要望をいただいています。回答時にご要望に対する補足説明を含めてください。 "
     
                 
-                first_item_idx = int(ids[0][0])
-                first_image_name = None
-                if on_text:
-                    first_image_name = st.session_state["ref_idx_text"][first_item_idx]
-                else:
-                    first_image_name = st.session_state["ref_idx_img"][first_item_idx]
-                first_image = Image.open(os.path.join(save_dir, first_image_name))
-                first_desc = get_item_desc(first_image_name)        
+                    # 比較用のベクトルは再計算せず、インデックスから復元する
+                    # ハイブリッドの場合は同じ尺度で比較できるよう、全商品を画像のインデックスから復元する
+                    compare_label = labels[0] if len(labels) == 1 else "img"
+                    vectorDB = st.session_state["vectorDB_text" if compare_label == "text" else "vectorDB_img"]
+                    similarities = comparison_similarities(vectorDB, comparison_rows(hits, compare_label))
+
+                    first_image_name = hits[0]["image_name"]
+                    first_image_path = os.path.join(save_dir, first_image_name)
+                    first_image = image_store.get_image(first_image_path)
+                    first_desc = get_item_desc(first_image_name)        
                 
-                for i, idx in enumerate(ids[0]):
-                    if idx == -1 or i == 0:
-                        continue
-                    comp_item_idx = int(ids[0][i])
-                    comp_image_name = None
-                    if on_text:
-                        comp_image_name = st.session_state["ref_idx_text"][comp_item_idx]
-                    else:
-                        comp_image_name = st.session_state["ref_idx_img"][comp_item_idx]
-                    comp_image = Image.open(os.path.join(save_dir, comp_image_name))
-                    comp_desc = get_item_desc(comp_image_name)        
+                    for i, hit in enumerate(hits[1:]):
+                        comp_image_name = hit["image_name"]
+                        comp_image_path = os.path.join(save_dir, comp_image_name)
+                        comp_image = image_store.get_image(comp_image_path)
+                        comp_desc = get_item_desc(comp_image_name)        
         
-                    similarity = calc_similarity(
-                        first_desc, 
-                        first_image, 
-                        comp_desc, 
-                        comp_image,
-                    )
-                    rate_limiter.wait()
-                    api = common.BedrockAPI()
-                    compare_text = api.get_compare_message(
-                        first_image, 
-                        first_desc, 
-                        comp_image,
-                        comp_desc, 
-                        system_prompt=item_compare_system_prompt,
-                        modelId = "anthropic.claude-3-haiku-20240307-v1:0"
-                    )
-                    first_item_col, comp_item_col = st.columns(2)
-                    with first_item_col:
-                        st.image(first_image, caption = first_image_name)
-                    with comp_item_col:
-                        st.image(comp_image, caption = comp_image_name)
-                    st.write(f"商品類似度: {similarity}")
-                    st.write(compare_text)
-                    st.markdown("---")
+                        similarity = similarities[i]
+                        future = executor.submit(
+                            bedrock_api.get_compare_message,
+                            first_image, 
+                            first_desc, 
+                            comp_image,
+                            comp_desc, 
+                            system_prompt=item_compare_system_prompt,
+                            modelId = "anthropic.claude-3-haiku-20240307-v1:0"
+                        )
+                        first_item_col, comp_item_col = st.columns(2)
+                        with first_item_col:
+                            # サムネイルを拡大して表示しないよう、幅はサムネイルのサイズまでにする
+                            st.image(image_store.get_thumbnail(first_image_path), caption = first_image_name, width=image_store.THUMBNAIL_SIZE[0])
+                        with comp_item_col:
+                            st.image(image_store.get_thumbnail(comp_image_path), caption = comp_image_name, width=image_store.THUMBNAIL_SIZE[0])
+                        if similarity is None:
+                            st.write("商品類似度: -（比較に使うインデックスに登録されていない商品です）")
+                        else:
+                            st.write(f"商品類似度: {similarity}")
+                        placeholder = st.empty()
+                        placeholder.caption("比較結果を生成中です...")
+                        futures[future] = placeholder
+                        st.markdown("---")
+
+                render_when_completed(futures)
+            finally:
+                # 生成中にウィジェットが操作されると再実行の例外で中断されるため、未着手の生成は取り消す
+                executor.shutdown(wait=False, cancel_futures=True)
+            with st.expander("Bedrock レート制限の待機時間"):
+                st.json(common.get_rate_limit_metrics())
 
 # if __name__ == "__main__":
 main()